@@ -0,0 +1,31 @@
+import sys
+import time
+from fractions import Fraction
+
+sys.path.append('../Common')
+from Constants import *
+from MessageSocket import packHeader, unpackHeader
+
+# Frame header: legacy str((header,'')) + eval vs binary struct header, per header
+# Run from the Benchmarks directory: python benchHeaders.py
+
+
+def bench(name, function, loops=20000):
+    function()
+    start = time.perf_counter()
+    for _ in range(loops):
+        function()
+    elapsed = (time.perf_counter() - start) / loops
+    print('%-20s %8.2f us' % (name, elapsed * 1000000.))
+
+
+if __name__ == '__main__':
+    header = {'type': HEADER_IMAGE, 'count': 1234, 'bracket': 2, 'shutter': 8000,
+              'gains': (Fraction(3, 2), Fraction(5, 4)), 'analog_gain': Fraction(1), 'digital_gain': Fraction(1)}
+    legacy = str((header, '')).encode()
+    binary = packHeader(header)
+    print('legacy %d bytes, binary %d bytes' % (len(legacy), len(binary)))
+    bench('legacy encode', lambda: str((header, '')).encode())
+    bench('legacy decode', lambda: eval(legacy.decode())[0])
+    bench('binary encode', lambda: packHeader(header))
+    bench('binary decode', lambda: unpackHeader(binary))
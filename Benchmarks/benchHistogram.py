@@ -0,0 +1,43 @@
+import sys
+import time
+import numpy as np
+import cv2
+
+sys.path.append('../GUIControl_Refactor')
+from ImageProcessing import calcHistograms
+
+# Histogram: 3 full resolution cv2.calcHist vs subsampled single pass, on 12MP frames
+# Run from the Benchmarks directory: python benchHistogram.py
+
+
+def calcHistogramFull(image):
+    histos = []
+    for i in range(3):
+        histo = cv2.calcHist([image], [i], None, [256], [0, 256])
+        histos.append(histo)
+    return histos
+
+
+def bench(name, function, image, loops=20):
+    function(image)
+    start = time.perf_counter()
+    for _ in range(loops):
+        function(image)
+    elapsed = (time.perf_counter() - start) / loops
+    print('%-28s %8.2f ms' % (name, elapsed * 1000.))
+    return elapsed
+
+
+if __name__ == '__main__':
+    image = cv2.GaussianBlur(np.random.randint(0, 256, (3040, 4056, 3), np.uint8), (0, 0), 8)
+    full = bench('calcHist x3 full', calcHistogramFull, image)
+    for samples in (1000000, 250000, 50000):
+        t = bench('subsampled %d samples' % samples, lambda im: calcHistograms(im, samples), image)
+        print('%-28s %8.1fx' % ('', full / t))
+    # Shape of the distribution is kept
+    reference = calcHistogramFull(image)
+    histos = calcHistograms(image, 250000)
+    for i in range(3):
+        a = reference[i].ravel() / reference[i].sum()
+        b = histos[i].ravel() / histos[i].sum()
+        print('channel %d max bin error %.5f' % (i, np.abs(a - b).max()))
@@ -0,0 +1,73 @@
+import sys
+import time
+import resource
+import multiprocessing
+import numpy as np
+import cv2
+
+sys.path.append('../GUIControl_Refactor')
+from ImageProcessing import finishMerge
+
+# Peak RSS of a merged frame: Mertens post processing with full frame float temporaries
+# (normalize, calibration multiply, *255, clip, astype) vs the fused finishMerge into a
+# reused uint8 buffer, on 12MP 3 exposure brackets
+# Each variant runs in its own process so its peak is not hidden by the other one
+# 'merge' includes cv2 MergeMertens, whose own temporaries set the peak of a full merge,
+# 'post' starts from a merged float32 frame to show what the post processing adds
+# Run from the Benchmarks directory: python benchMergeMemory.py [frames]
+
+
+def peakMB():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # kB on Linux
+
+
+def oldPost(image, table, out):
+    image = cv2.normalize(image, None, 0., 1., cv2.NORM_MINMAX)
+    image = cv2.multiply(image, table)
+    return np.clip(image*255, 0, 255).astype('uint8')
+
+
+def fusedPost(image, table, out):
+    return finishMerge(image, table, out, normalize=True)
+
+
+def run(name, withMerge, frames, results):
+    shape = (3040, 4056, 3)
+    base = cv2.GaussianBlur(np.random.randint(0, 256, shape, np.uint8), (0, 0), 4)
+    exposures = [cv2.convertScaleAbs(base, None, gain) for gain in (0.5, 1., 2.)]
+    table = np.random.uniform(0.9, 1.1, shape).astype(np.float32)
+    out = np.empty(shape, np.uint8)
+    mergeMertens = cv2.createMergeMertens(1, 1, 1)
+    post = oldPost if name == 'old' else fusedPost
+    before = peakMB()
+    start = time.perf_counter()
+    postTime = 0.
+    for _ in range(frames):
+        if withMerge:
+            merged = mergeMertens.process(exposures)
+        else:
+            merged = cv2.randu(np.empty(shape, np.float32), -0.1, 1.2)
+        inputsPeak = peakMB()
+        t = time.perf_counter()
+        image = post(merged, table, out)
+        postTime += time.perf_counter() - t
+        del merged
+    results[(name, withMerge)] = (before, inputsPeak, peakMB(), (time.perf_counter() - start) / frames, postTime / frames)
+
+
+if __name__ == '__main__':
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    manager = multiprocessing.Manager()
+    results = manager.dict()
+    print('%-14s %10s %10s %10s %10s %10s' % ('', 'setup MB', 'input MB', 'peak MB', 'frame ms', 'post ms'))
+    for withMerge in (False, True):
+        for name in ('old', 'fused'):
+            process = multiprocessing.Process(target=run, args=(name, withMerge, frames, results))
+            process.start()
+            process.join()
+            before, inputs, peak, frame, post = results[(name, withMerge)]
+            print('%-14s %10.0f %10.0f %10.0f %10.0f %10.1f' % (name + (' merge' if withMerge else ' post'),
+                  before, inputs, peak, frame * 1000., post * 1000.))
+    for name in ('old', 'fused'):
+        before, inputs, peak, frame, post = results[(name, False)]
+        print('%s post processing: peak %.0f MB above the setup' % (name, peak - before))
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import resource
+import multiprocessing
+import numpy as np
+import cv2
+
+sys.path.append('../GUIControl_Refactor')
+from ImageProcessing import tiledMertens, mertensTileSize
+
+# Tiled Mertens merge: peak RSS, time and difference with the whole frame merge
+# for several memory budgets, on 12MP 3 exposure brackets, one process per run
+# Run from the Benchmarks directory: python benchTiledMerge.py
+
+
+def peakMB():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # kB on Linux
+
+
+def brackets(shape):
+    height, width = shape[:2]
+    # Smooth gradient (the low frequencies the pyramid blends) plus texture
+    gradient = np.linspace(20, 235, width, dtype=np.float32)[np.newaxis, :] * \
+        np.linspace(0.6, 1.2, height, dtype=np.float32)[:, np.newaxis]
+    texture = cv2.GaussianBlur(np.random.randint(0, 256, shape, np.uint8), (0, 0), 3).astype(np.float32) - 128.
+    base = np.clip(gradient[:, :, np.newaxis] + texture, 0, 255).astype(np.uint8)
+    return [cv2.convertScaleAbs(base, None, gain) for gain in (0.5, 1., 2.)]
+
+
+def run(budget, results):
+    exposures = list(np.load('brackets.npy'))  # No generation temporaries in the peak
+    out = np.empty(exposures[0].shape, np.float32)
+    mergeMertens = cv2.createMergeMertens(1, 1, 1)
+    before = peakMB()
+    start = time.perf_counter()
+    if budget == 0:
+        out[...] = mergeMertens.process(exposures)
+        tile = 0
+    else:
+        tile = mertensTileSize(len(exposures), budget * 1000000)
+        tiledMertens(mergeMertens, exposures, out, tile)
+    elapsed = time.perf_counter() - start
+    peak = peakMB()
+    image = cv2.normalize(out, None, 0., 255., cv2.NORM_MINMAX, cv2.CV_8U)
+    np.save('merged_%d.npy' % budget, image)
+    results[budget] = (tile, peak - before, elapsed)
+
+
+if __name__ == '__main__':
+    np.random.seed(1)
+    np.save('brackets.npy', np.stack(brackets((3040, 4056, 3))))
+    manager = multiprocessing.Manager()
+    results = manager.dict()
+    budgets = (0, 400, 200, 100, 50)
+    for budget in budgets:
+        process = multiprocessing.Process(target=run, args=(budget, results))
+        process.start()
+        process.join()
+    reference = np.load('merged_0.npy').astype(np.int16)
+    print('%-10s %8s %10s %10s %10s %10s' % ('budget MB', 'tile', 'merge MB', 'time ms', 'mean diff', 'p99.9 diff'))
+    for budget in budgets:
+        tile, peak, elapsed = results[budget]
+        diff = np.abs(np.load('merged_%d.npy' % budget).astype(np.int16) - reference)
+        print('%-10s %8d %10.0f %10.0f %10.2f %10d' % (budget or 'whole', tile, peak, elapsed * 1000.,
+                                                       diff.mean(), np.percentile(diff, 99.9)))
+    for budget in budgets:
+        os.remove('merged_%d.npy' % budget)
+    os.remove('brackets.npy')
@@ -89,3 +89,11 @@ V3_RESOLUTIONS=('1920x1080','2028x1520','4056x3040','1012x760')
 CALIBRATION_NONE=1
 CALIBRATION_FLAT=2
 CALIBRATION_TABLE=3
+
+FSYNC_NONE=0
+FSYNC_FRAME=1
+FSYNC_CLIP=2
+
+PREVIEW_MERGE_NONE=0
+PREVIEW_MERGE_REDUCED=1
+PREVIEW_MERGE_EXPOSURE=2
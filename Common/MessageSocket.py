@@ -1,6 +1,9 @@
 import socket
+import json
+import threading
 from struct import *  
 from numpy import *    #for dtype
+from builtins import min, max, round, abs, sum, any, all    #not the numpy ones, this module is star imported
 import numpy as np
 from ast import literal_eval
 from fractions import Fraction 
@@ -9,47 +12,243 @@ from fractions import Fraction
 ## send a receive a messge ie a counted bytes buf
 ## On top of a message send a receive a Python string
 ## On top of a string send a receive a Python object
+## Frame headers can travel as a binary message (see Binary headers)
+## Receive is buffered: small messages (length, header) and the start of the next payload
+## come in one recv_into, large payloads are received straight into their buffer
+## Send: the length prefix and the payload (the array memory for sendArray) go in one
+## vectored sendmsg, no concatenation, no tobytes copy, one segment for small commands
+## receiveMsgLeased receives a message into a buffer leased from a BufferPool (no allocation
+## per frame), the buffer goes back to the pool when all the users have released it
+
+## Binary headers
+## A header message starts with HEADER_MAGIC (a legacy header, str((obj,'')), starts with '(')
+## then a fixed struct: version, flags (fixed fields present), type, bracket, count, shutter,
+## red and blue gains, analog gain, digital gain (float64, the same values as float(Fraction)
+## in a legacy header), extension length
+## The other keys of the header dict follow as compact json (the extension), Fractions as floats
+## The client offers the version when it connects the image socket, the server answers with
+## binary headers only if it got the offer, a legacy server ignores it.
+## receiveHeader takes both forms, a binary header of another version is refused (ValueError)
+HEADER_MAGIC = 0xB7
+HEADER_VERSION = 1
+HEADER_STRUCT = Struct('<BBBBbIi4dH')
+HEADER_HELLO = Struct('<4sB')
+HEADER_HELLO_TAG = b'YHDR'
+HEADER_BITS = {'count': 1, 'bracket': 2, 'shutter': 4, 'gains': 8, 'analog_gain': 16, 'digital_gain': 32}
+
+#Header dict to binary header message
+def packHeader(header):
+    flags = 0
+    extension = {}
+    for key, value in header.items():
+        if key in HEADER_BITS:
+            flags |= HEADER_BITS[key]
+        elif key != 'type':
+            extension[key] = value
+    gains = header.get('gains', (0., 0.))
+    ext = json.dumps(extension, separators=(',', ':'), default=float).encode() if extension else b''
+    return HEADER_STRUCT.pack(HEADER_MAGIC, HEADER_VERSION, flags, header['type'],
+                              int(header.get('bracket', 0)), int(header.get('count', 0)), int(header.get('shutter', 0)),
+                              float(gains[0]), float(gains[1]),
+                              float(header.get('analog_gain', 0.)), float(header.get('digital_gain', 0.)),
+                              len(ext)) + ext
+
+#Binary header message to header dict
+def unpackHeader(buf):
+    (magic, version, flags, typ, bracket, count, shutter,
+     red, blue, analog, digital, extLen) = HEADER_STRUCT.unpack_from(buf)
+    if version != HEADER_VERSION:
+        raise ValueError('Unsupported header version %d' % version)
+    header = {'type': typ}
+    if flags & 1:
+        header['count'] = count
+    if flags & 2:
+        header['bracket'] = bracket
+    if flags & 4:
+        header['shutter'] = shutter
+    if flags & 8:
+        header['gains'] = (red, blue)
+    if flags & 16:
+        header['analog_gain'] = analog
+    if flags & 32:
+        header['digital_gain'] = digital
+    if extLen:
+        header.update(json.loads(bytes(buf[HEADER_STRUCT.size:HEADER_STRUCT.size + extLen])))
+    return header
+
+#Receive buffers reused across messages
+class BufferPool() :
+    granularity = 1 << 18   #Buffers are allocated by 256KB so close sizes share buffers
+
+    def __init__(self, maxFree=16):
+        self.maxFree = maxFree
+        self.lock = threading.Lock()
+        self.free = []
+        self.allocated = 0  #Buffers allocated, stays flat in steady state
+
+    def lease(self, size):
+        with self.lock :
+            best = None
+            for i, buf in enumerate(self.free) :
+                if len(buf) >= size and (best is None or len(buf) < len(self.free[best])) :
+                    best = i
+            buf = self.free.pop(best) if best is not None else None
+        if buf is None :
+            buf = bytearray(-(-max(size, 1) // self.granularity) * self.granularity)
+            self.allocated += 1
+        return Lease(self, buf, size)
+
+    def give(self, buf):
+        with self.lock :
+            if len(self.free) < self.maxFree :
+                self.free.append(buf)
+
+#A buffer leased from a BufferPool, view holds the message
+#Each user that keeps it calls acquire() then release(), the receiver releases its own reference
+class Lease() :
+
+    def __init__(self, pool, buf, size):
+        self.pool = pool
+        self.buf = buf
+        self.view = memoryview(buf)[:size]
+        self.users = 1
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.view)
+
+    def acquire(self):
+        with self.lock :
+            self.users += 1
+        return self
+
+    def release(self):
+        with self.lock :
+            self.users -= 1
+            done = self.users == 0
+        if done :
+            self.pool.give(self.buf)
+
 
 class MessageSocket() :
     socket = None
+    headerVersion = 0   #Binary headers sent if > 0, see acceptHeaderProtocol
+    stagingSize = 1 << 16
     
     def __init__(self, sock):
         self.socket = sock
+        self.staging = bytearray(self.stagingSize)
+        self.stagingView = memoryview(self.staging)
+        self.stagingStart = 0
+        self.stagingEnd = 0
 
     def close(self):
         self.socket.close()
     
     def shutdown(self) :
         self.socket.shutdown(socket.SHUT_RDWR)
+
+#Send small messages at once (commands), no Nagle delay
+    def setNoDelay(self) :
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+#Send buffers in order, one sendmsg call if the socket takes them all
+#Without sendmsg (Windows) small buffers are joined, large ones sent one by one
+    def sendBuffers(self, buffers):
+        views = [memoryview(buf).cast('B') for buf in buffers]
+        if not hasattr(self.socket, 'sendmsg') :
+            if sum(view.nbytes for view in views) <= self.stagingSize :
+                self.socket.sendall(b''.join(views))
+            else :
+                for view in views :
+                    self.socket.sendall(view)
+            return
+        while views :
+            n = self.socket.sendmsg(views)
+            while views and n >= views[0].nbytes :
+                n -= views[0].nbytes
+                views.pop(0)
+            if n :
+                views[0] = views[0][n:]
     
 #Read len bytes on the socket
     def read(self, len):
         buf = bytearray(len)
-        view = memoryview(buf)
-        while len :
-            n = self.socket.recv_into(view, len)
-            if n == 0 :
-                return None
-            view = view[n:]
-            len -= n
+        if not self.readInto(memoryview(buf)) :
+            return None
         return buf
 
+#Fill view from the staging buffer then the socket, False if the connection is closed
+#A small read refills the staging buffer, a large one goes straight to view
+    def readInto(self, view):
+        size = len(view)
+        while size :
+            staged = self.stagingEnd - self.stagingStart
+            if staged :
+                n = staged if staged < size else size
+                view[:n] = self.stagingView[self.stagingStart:self.stagingStart + n]
+                self.stagingStart += n
+            elif size < self.stagingSize // 2 :
+                n = self.socket.recv_into(self.stagingView, self.stagingSize)
+                if n == 0 :
+                    return False
+                self.stagingStart = 0
+                self.stagingEnd = n
+                continue
+            else :
+                n = self.socket.recv_into(view, size)
+                if n == 0 :
+                    return False
+            view = view[n:]
+            size -= n
+        return True
+
+#Read a length prefix, None if the connection is closed
+    def readLength(self):
+        if self.stagingEnd - self.stagingStart < 4 :
+            buf = self.read(4)
+            return unpack('<i', buf)[0] if buf is not None else None
+        length = unpack_from('<i', self.staging, self.stagingStart)[0]
+        self.stagingStart += 4
+        return length
+
 
 #Send len and bytes
     def sendMsg(self,buf):
         try :
-            self.socket.sendall(pack('<i',len(buf)))
-            self.socket.sendall(buf)
+            self.sendBuffers((pack('<i',len(buf)), buf))
         except :
             print('Exception sending')
 
 #Receive len and bytes
     def receiveMsg(self):    
-        buf = self.read(calcsize('<i'))
-        if buf != None :
-            len = unpack('<i',buf)[0]
-            buf = self.read(len)
-        return buf
+        len = self.readLength()
+        if len is None :
+            return None
+        return self.read(len)
+
+#Receive a message into buf (a writable buffer large enough), returns its length or None
+    def receiveMsgInto(self, buf):
+        len = self.readLength()
+        if len is None :
+            return None
+        view = memoryview(buf)
+        if view.nbytes < len :
+            raise ValueError('Message of %d bytes, buffer of %d' % (len, view.nbytes))
+        if not self.readInto(view.cast('B')[:len]) :
+            return None
+        return len
+
+#Receive a message into a buffer leased from pool, returns the Lease or None
+    def receiveMsgLeased(self, pool):
+        len = self.readLength()
+        if len is None :
+            return None
+        lease = pool.lease(len)
+        if not self.readInto(lease.view) :
+            lease.release()
+            return None
+        return lease
 
 #Send a string
     def sendString(self,s):
@@ -57,7 +256,10 @@ class MessageSocket() :
 
 #Receive a string
     def receiveString(self):
-        return self.receiveMsg().decode()
+        buf = self.receiveMsg()
+        if buf is None :
+            raise ConnectionError('Connection closed')
+        return buf.decode()
 
 ##Send a receive a python object
 ## For sending the object is converted to its string representation
@@ -72,10 +274,11 @@ class MessageSocket() :
         s = self.receiveString()
         return eval(s)[0]
 
-#Send a numpy array
+#Send a numpy array, from its memory if contiguous
     def sendArray(self,array):
-        self.sendObject((array.nbytes, array.shape, array.dtype))
-        self.socket.sendall(array.tobytes())
+        array = np.ascontiguousarray(array)
+        infos = str(((array.nbytes, array.shape, array.dtype),'')).encode()
+        self.sendBuffers((pack('<i',len(infos)), infos, array.reshape(-1).view(np.uint8)))
 
 #Receive a numpy array        
     def receiveArray(self):
@@ -83,3 +286,42 @@ class MessageSocket() :
         size = infos[0]
         buf = self.read(size)
         return np.frombuffer(buf, infos[2]).reshape(infos[1])
+
+##Frame headers
+
+#Client: offer binary headers, when the socket is connected
+    def offerHeaderProtocol(self):
+        self.sendMsg(HEADER_HELLO.pack(HEADER_HELLO_TAG, HEADER_VERSION))
+
+#Server: wait timeout seconds for the client offer, binary headers if there is one
+    def acceptHeaderProtocol(self, timeout=1.):
+        previous = self.socket.gettimeout()
+        self.socket.settimeout(timeout)
+        try :
+            buf = self.receiveMsg()
+        except socket.timeout :
+            buf = None  #Legacy client
+        finally :
+            self.socket.settimeout(previous)
+        self.headerVersion = 0
+        if buf is not None and len(buf) == HEADER_HELLO.size :
+            tag, version = HEADER_HELLO.unpack(buf)
+            if tag == HEADER_HELLO_TAG :
+                self.headerVersion = min(version, HEADER_VERSION)
+        return self.headerVersion
+
+#Send a header dict, binary if negotiated
+    def sendHeader(self, header):
+        if self.headerVersion > 0 :
+            self.sendMsg(packHeader(header))
+        else :
+            self.sendObject(header)
+
+#Receive a header dict, binary or legacy
+    def receiveHeader(self):
+        buf = self.receiveMsg()
+        if buf is None :
+            return None
+        if len(buf) and buf[0] == HEADER_MAGIC :
+            return unpackHeader(buf)
+        return eval(buf.decode())[0]
@@ -0,0 +1,205 @@
+import sys
+import time
+import socket
+import threading
+import argparse
+import queue
+import numpy as np
+import cv2
+from Constants import *
+from MessageSocket import *
+
+## Stand-in for the Pi server, to run the GUI and test the protocol without a scanner
+## Same port and connection order as the Pi: the command socket, then the image socket
+## Commands are answered from plain dicts, a capture sends synthetic Jpeg frames
+## (bracket sets if 'bracket_steps' > 1) with their headers, binary if the client offers it
+## Replies can be delayed by a latency (slow link), they are still sent in order
+## Run: python StandInServer.py [--port 8000] [--legacy] [--latency 0.05]
+
+
+class StandInServer:
+
+    def __init__(self, host='localhost', port=8000, legacy=False, width=1014, height=760, latency=0.):
+        self.host = host
+        self.port = port
+        self.legacy = legacy  # Never answer the binary header offer
+        self.latency = latency  # Seconds between a command and its reply
+        self.dropReplies = 0  # Replies not sent (tests: a command the Pi does not answer)
+        self.width = width
+        self.height = height
+        self.cameraSettings = {'resolution': (width, height), 'shutter_speed': 8000, 'exposure_speed': 8000,
+                               'framerate': 10., 'iso': 100, 'exposure_compensation': 0,
+                               'awb_gains': (Fraction(3, 2), Fraction(5, 4)), 'analog_gain': Fraction(1),
+                               'digital_gain': Fraction(1), 'bracket_steps': 1, 'bracket_dark_coefficient': 1.,
+                               'bracket_light_coefficient': 1., 'auto_pause': False, 'zoom': (0., 0., 1., 1.)}
+        self.motorSettings = {'speed': 100, 'pulley_ratio': 1, 'steps_per_rev': 200}
+        self.listener = None
+        self.commandSock = None
+        self.imageSock = None
+        self.sendLock = threading.Lock()  # Image socket: capture thread and commands
+        self.capturing = threading.Event()
+        self.captureThread = None
+        self.count = 0
+        self.commands = 0  # Commands received
+        self.replies = queue.Queue()  # (due time, reply) when there is a latency
+        self.replyThread = None
+
+    def start(self):
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.port = self.listener.getsockname()[1]  # Port 0: any free port
+        self.listener.listen(2)
+        thread = threading.Thread(target=self.serve, name='StandInServer', daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self):
+        sock, _ = self.listener.accept()
+        self.commandSock = MessageSocket(sock)
+        self.commandSock.setNoDelay()
+        sock, _ = self.listener.accept()
+        self.imageSock = MessageSocket(sock)
+        if not self.legacy:
+            self.imageSock.acceptHeaderProtocol()
+        if self.latency > 0:
+            self.replyThread = threading.Thread(target=self.sendReplies, name='StandInReplies', daemon=True)
+            self.replyThread.start()
+        try:
+            while self.command():
+                pass
+        except OSError:
+            pass  # Closed by stop()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.capturing.clear()
+        if self.captureThread is not None:
+            self.captureThread.join()
+            self.captureThread = None
+        if self.replyThread is not None:
+            self.replies.put(None)
+            self.replyThread.join()
+            self.replyThread = None
+        for sock in (self.commandSock, self.imageSock):
+            if sock is not None:
+                try:
+                    sock.shutdown()  # The client sees the connection closed
+                except OSError:
+                    pass
+                sock.close()
+        if self.listener is not None:
+            self.listener.close()
+
+    def reply(self, obj):
+        if self.dropReplies > 0:
+            self.dropReplies -= 1
+            return
+        if self.latency > 0:
+            self.replies.put((time.time() + self.latency, obj))
+        else:
+            self.commandSock.sendObject(obj)
+
+# Delayed replies, in order: the commands that follow are not held up
+    def sendReplies(self):
+        while True:
+            item = self.replies.get()
+            if item is None:
+                break
+            due, obj = item
+            time.sleep(max(0., due - time.time()))
+            try:
+                self.commandSock.sendObject(obj)
+            except OSError:
+                break
+
+# Handle one command, False when the connection is done
+    def command(self):
+        buf = self.commandSock.receiveMsg()
+        if buf is None:
+            return False
+        command = eval(buf.decode())[0]
+        self.commands += 1
+        typ = command[0]
+        if typ == GET_CAMERA_SETTINGS:
+            self.reply(self.cameraSettings)
+        elif typ == GET_CAMERA_SETTING:
+            self.reply(self.cameraSettings.get(command[1]))
+        elif typ == GET_MOTOR_SETTINGS:
+            self.reply(self.motorSettings)
+        elif typ == SET_CAMERA_SETTINGS:
+            self.cameraSettings.update(command[1])
+        elif typ == SET_MOTOR_SETTINGS:
+            self.motorSettings.update(command[1])
+        elif typ == WHITE_BALANCE:
+            self.reply(self.cameraSettings['awb_gains'])
+        elif typ == MAX_FPS:
+            self.cameraSettings['framerate'] = 30.  # No reply, the GUI gets 'framerate' after
+        elif typ == TAKE_IMAGE:
+            self.sendBracketSet()
+        elif typ == TAKE_BGR:
+            self.sendBgr(command[1], command[2])
+        elif typ == START_CAPTURE:
+            self.capturing.set()
+            self.captureThread = threading.Thread(target=self.capture, name='StandInCapture', daemon=True)
+            self.captureThread.start()
+        elif typ == STOP_CAPTURE:
+            self.capturing.clear()
+            if self.captureThread is not None:
+                self.captureThread.join()
+                self.captureThread = None
+        elif typ == TERMINATE:
+            with self.sendLock:
+                self.imageSock.sendHeader({'type': HEADER_STOP})
+            return False
+        return True  # Other commands (motor, camera open/close...) need no answer
+
+    def capture(self):
+        while self.capturing.is_set():
+            start = time.time()
+            self.sendBracketSet()
+            period = 1. / max(float(self.cameraSettings['framerate']), 0.1)
+            time.sleep(max(0., period - (time.time() - start)))
+
+# A frame: moving gradient, one exposure per bracket (bracket 3 2 1, 0 without brackets)
+    def frame(self, gain):
+        x = np.arange(self.width, dtype=np.float32)
+        row = 128. + 100. * np.sin((x + self.count * 8) / 40.)
+        image = np.empty((self.height, self.width, 3), np.uint8)
+        image[...] = np.clip(row * gain, 0, 255).astype(np.uint8)[np.newaxis, :, np.newaxis]
+        return cv2.imencode('.jpg', image)[1]
+
+    def sendBracketSet(self):
+        brackets = int(self.cameraSettings['bracket_steps'])
+        shutter = int(self.cameraSettings['shutter_speed']) or 8000
+        for bracket in range(brackets, 0, -1) if brackets > 1 else (0,):
+            gain = 2. ** (bracket - 2) if brackets > 1 else 1.
+            header = {'type': HEADER_IMAGE, 'count': self.count, 'bracket': bracket,
+                      'shutter': int(shutter * gain), 'gains': self.cameraSettings['awb_gains'],
+                      'analog_gain': self.cameraSettings['analog_gain'],
+                      'digital_gain': self.cameraSettings['digital_gain']}
+            jpeg = self.frame(gain)
+            with self.sendLock:
+                self.imageSock.sendHeader(header)
+                self.imageSock.sendMsg(jpeg)
+        self.count += 1
+
+    def sendBgr(self, typ, frames):
+        for i in range(frames):
+            image = cv2.imdecode(self.frame(1.), 1)
+            header = {'type': typ, 'num': i, 'count': frames}
+            with self.sendLock:
+                self.imageSock.sendHeader(header)
+                self.imageSock.sendArray(image)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in Pi server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--legacy', action='store_true', help='legacy string headers only')
+    parser.add_argument('--latency', type=float, default=0., help='reply delay in seconds')
+    args = parser.parse_args()
+    server = StandInServer(args.host, args.port, args.legacy, latency=args.latency)
+    server.start().join()
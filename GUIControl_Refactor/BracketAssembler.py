@@ -0,0 +1,147 @@
+import time
+import threading
+import numpy as np
+
+# Bracket assembly
+# The exposures of a frame (bracket n .. 1, same header['count']) are decoded by different
+# workers, possibly out of order. Each one is copied into its slot of a preallocated
+# (n, height, width, 3) uint8 buffer reserved for that count.
+# Buffers are reused: memory stays flat over a reel. They are allocated when needed, up to
+# maxSets: size it for the sets being written, merged and waiting to be merged at once.
+# When all the buffers are in use the worker waits for one (back pressure), a set being
+# written is never evicted to make room.
+# A set that does not complete (dropped exposure, capture stopped mid bracket) is evicted
+# once nobody writes it and it is older than timeout seconds, so a missing exposure is never
+# merged with the exposures of another frame. evicted(count) is called for each evicted set.
+
+
+class BracketSet:
+
+    def __init__(self, count, buffer):
+        self.count = count
+        self.buffer = buffer
+        self.shutters = [0] * len(buffer)
+        self.reserved = set()  # Slots being written or written
+        self.written = 0
+        self.started = time.time()
+        self.evicted = False
+        self.users = 0  # Workers writing into the buffer
+
+    def images(self):
+        return [self.buffer[i] for i in range(len(self.buffer))]
+
+
+class BracketAssembler:
+
+    def __init__(self, maxSets=8, timeout=5., evicted=None):
+        self.maxSets = max(1, maxSets)
+        self.timeout = timeout
+        self.evicted = evicted
+        self.lock = threading.Condition()  # Notified when a buffer is given back
+        self.pending = {}  # count -> BracketSet
+        self.freeBuffers = []
+        self.allocated = 0
+        self.evictedSets = 0
+
+# Reserve the slot of an exposure, returns (bracketSet, index) or None if it cannot be used
+    def reserve(self, count, bracket, brackets, shape):
+        index = brackets - bracket  # We receive bracket 3 2 1
+        if index < 0 or index >= brackets:
+            return None
+        with self.lock:
+            while True:
+                self.evictExpired()
+                bracketSet = self.pending.get(count)
+                if bracketSet is not None and bracketSet.buffer.shape != (brackets,) + tuple(shape):
+                    self.evict(bracketSet)  # Resolution or bracket count changed
+                    bracketSet = None
+                if bracketSet is not None:
+                    break
+                buffer = self.takeBuffer(brackets, shape)
+                if buffer is not None:
+                    bracketSet = BracketSet(count, buffer)
+                    self.pending[count] = bracketSet
+                    break
+                self.lock.wait(self.waitTime())  # Until a buffer comes back or a set expires
+            if index in bracketSet.reserved:
+                return None  # Same exposure twice
+            bracketSet.reserved.add(index)
+            bracketSet.users += 1
+        return bracketSet, index
+
+# Copy a decoded exposure in its slot, returns True when the set is complete
+    def write(self, bracketSet, index, image, shutter):
+        try:
+            np.copyto(bracketSet.buffer[index], image)
+        finally:
+            with self.lock:
+                bracketSet.users -= 1
+                bracketSet.shutters[index] = shutter
+                bracketSet.written += 1
+                if bracketSet.evicted:
+                    self.recycle(bracketSet)
+                    return False
+                if bracketSet.written < len(bracketSet.buffer):
+                    return False
+                del self.pending[bracketSet.count]
+        return True
+
+# Give the buffer of a merged set back
+    def release(self, bracketSet):
+        with self.lock:
+            bracketSet.evicted = True
+            self.recycle(bracketSet)
+
+# A new capture: the incomplete sets of the previous one are dropped, not reported
+    def clear(self):
+        with self.lock:
+            for bracketSet in list(self.pending.values()):
+                self.evict(bracketSet, report=False)
+
+    def pendingSets(self):
+        with self.lock:
+            return len(self.pending)
+
+# Internals, called with the lock held
+    def takeBuffer(self, brackets, shape):
+        shape = (brackets,) + tuple(shape)
+        while True:
+            for i, buffer in enumerate(self.freeBuffers):
+                if buffer.shape == shape:
+                    return self.freeBuffers.pop(i)
+            if self.freeBuffers:
+                self.freeBuffers.pop()  # Other resolution, let it go
+                self.allocated -= 1
+                continue
+            if self.allocated < self.maxSets:
+                self.allocated += 1
+                return np.empty(shape, np.uint8)
+            return None  # All in use, wait
+
+    def evict(self, bracketSet, report=True):
+        del self.pending[bracketSet.count]
+        bracketSet.evicted = True
+        if report:
+            self.evictedSets += 1
+            if self.evicted is not None:
+                self.evicted(bracketSet.count)
+        self.recycle(bracketSet)
+
+    def evictExpired(self):
+        now = time.time()
+        for bracketSet in list(self.pending.values()):
+            if bracketSet.users == 0 and now - bracketSet.started > self.timeout:
+                self.evict(bracketSet)
+
+# Seconds until the oldest pending set may expire
+    def waitTime(self):
+        if not self.pending:
+            return self.timeout
+        oldest = min(bracketSet.started for bracketSet in self.pending.values())
+        return max(0.01, oldest + self.timeout - time.time())
+
+    def recycle(self, bracketSet):
+        if bracketSet.users == 0 and bracketSet.buffer is not None:
+            self.freeBuffers.append(bracketSet.buffer)
+            bracketSet.buffer = None
+            self.lock.notify_all()
@@ -0,0 +1,231 @@
+import sys
+import time
+import queue
+import itertools
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import Future
+
+sys.path.append('../Common')
+from Constants import *
+
+# Asynchronous command channel to the Pi
+# The GUI never waits on the socket: commands are queued and sent by a sender thread,
+# replies are read by a receiver thread and delivered through futures.
+# Every request gets an id. The Pi answers the commands that have a reply in the order it
+# received them and does not echo ids, so replies are matched to the oldest pending
+# request: several requests can be in flight on a slow link (pipelining) without
+# changing the Pi protocol.
+# Only the commands the Pi answers (REPLY_COMMANDS) can be requests.
+# Timeout policy: TCP does not lose replies, a request without a reply after timeout seconds
+# got none (a command without reply sent as a request, an error on the Pi). From then on the
+# replies cannot be matched by position: all the pending requests fail with CommandTimeout
+# and the channel resyncs. A GET_MOTOR_SETTINGS sentinel is sent (the Pi always answers it,
+# camera open or not) and the replies are dropped until its reply, recognized by its keys,
+# has come: the requests sent after it are matched again. Nothing is sent again.
+# Until the timeout the replies that follow a missing one go to the wrong requests, this is
+# why a command without reply is refused by request().
+# Camera settings are batched: setSettings merges the changes into one dict (last write
+# wins) sent as a single SET_CAMERA_SETTINGS after settingsInterval seconds, or before any
+# other command so the Pi sees them in order, or when flushSettings is called.
+
+
+REPLY_COMMANDS = (GET_CAMERA_SETTINGS, GET_CAMERA_SETTING, GET_MOTOR_SETTINGS, WHITE_BALANCE)
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class PendingRequest:
+
+    def __init__(self, requestId, command, future, timeout):
+        self.requestId = requestId
+        self.command = command
+        self.future = future
+        self.deadline = time.time() + timeout
+
+
+# The reply to the resync sentinel
+def isMotorSettings(reply):
+    return isinstance(reply, dict) and 'steps_per_rev' in reply
+
+
+class CommandClient:
+
+    def __init__(self, sock, timeout=5., settingsInterval=0.1):
+        self.sock = sock            # MessageSocket, only used by the sender and receiver threads
+        self.timeout = timeout
+        self.settingsInterval = settingsInterval  # 0 sends each change at once
+        self.batchLock = threading.Lock()
+        self.batch = None           # Pending camera settings
+        self.batchDue = 0.
+        self.outbox = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = deque()      # PendingRequest in send order
+        self.ids = itertools.count(1)
+        self.sentinels = 0          # Motor settings replies to drop before the channel is in step, 0 in step
+        self.sentinelDeadline = 0.
+        self.sender = None
+        self.receiver = None
+        self.running = False
+        # Counters
+        self.requests = 0
+        self.timeouts = 0
+        self.resyncs = 0
+        self.droppedReplies = 0     # Replies received while resyncing
+        self.settingsSent = 0
+        self.settingsSaved = 0      # SET_CAMERA_SETTINGS messages merged into another one
+
+    def start(self):
+        self.running = True
+        self.sender = threading.Thread(target=self.sendLoop, name='CommandSender', daemon=True)
+        self.receiver = threading.Thread(target=self.receiveLoop, name='CommandReceiver', daemon=True)
+        self.sender.start()
+        self.receiver.start()
+
+# Send what is queued and stop the sender, the receiver stops when the socket is closed
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.flushSettings()
+        self.outbox.put(None)
+        self.sender.join()
+
+# A command without reply
+    def send(self, command):
+        self.flushSettings()
+        self.outbox.put((command, None))
+
+# Camera settings, merged with the pending ones
+    def setSettings(self, settings):
+        with self.batchLock:
+            if self.batch is None:
+                self.batch = {}
+                self.batchDue = time.time() + self.settingsInterval
+            else:
+                self.settingsSaved += 1
+            self.batch.update(settings)
+        if self.settingsInterval <= 0:
+            self.flushSettings()
+
+# Queue the pending settings now (eg. focus out)
+    def flushSettings(self):
+        with self.batchLock:
+            if self.batch is None:
+                return
+            self.outbox.put(((SET_CAMERA_SETTINGS, self.batch), None))
+            self.batch = None
+            self.settingsSent += 1
+
+# A command with a reply, returns a Future (future.requestId) of the reply
+    def request(self, command):
+        if command[0] not in REPLY_COMMANDS:
+            raise ValueError('No reply to %s, use send' % (command,))
+        future = Future()
+        future.requestId = next(self.ids)
+        self.requests += 1
+        self.flushSettings()
+        self.outbox.put((command, future))
+        return future
+
+    def pendingCount(self):
+        with self.lock:
+            return len(self.pending)
+
+    def inStep(self):
+        return self.sentinels == 0
+
+    def statusText(self):
+        return 'commands {0} timeouts {1} settings sent {2} saved {3}'.format(
+            self.requests, self.timeouts, self.settingsSent, self.settingsSaved)
+
+    def sendLoop(self):
+        wait = min(0.1, max(self.settingsInterval / 2., 0.01))
+        while True:
+            try:
+                item = self.outbox.get(timeout=wait)
+            except queue.Empty:
+                self.flushDueSettings()
+                self.checkTimeouts()
+                continue
+            if item is None:
+                break
+            command, future = item
+            if future is not None:
+                if future.done():
+                    continue  # Cancelled
+                with self.lock:
+                    self.pending.append(PendingRequest(future.requestId, command, future, self.timeout))
+            self.sock.sendObject(command)
+            self.flushDueSettings()
+            self.checkTimeouts()
+
+    def flushDueSettings(self):
+        if self.batch is not None and time.time() >= self.batchDue:
+            self.flushSettings()
+
+    def receiveLoop(self):
+        try:
+            while True:
+                reply = self.sock.receiveObject()
+                with self.lock:
+                    if self.sentinels > 0:
+                        self.droppedReplies += 1
+                        if isMotorSettings(reply):
+                            self.sentinels -= 1  # 0: the sentinel reply, in step again
+                        continue
+                    request = self.pending.popleft() if self.pending else None
+                if request is None:
+                    print('Unexpected reply', reply)
+                elif not request.future.done():
+                    request.future.set_result(reply)
+        except OSError:
+            pass  # Socket closed
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.failPending(ConnectionError('Command connection closed'))
+
+# Called by the sender: a request (or the sentinel) without reply puts the channel out of step
+    def checkTimeouts(self):
+        now = time.time()
+        with self.lock:
+            expired = (self.pending and self.pending[0].deadline < now) or \
+                      (self.sentinels > 0 and self.sentinelDeadline < now)
+            if not expired:
+                return
+            pending = list(self.pending)
+            self.pending.clear()
+            # Motor settings replies still to come before the new sentinel reply: the pending ones
+            # (a timed out sentinel is given up, so an unanswered one cannot stall the resync)
+            self.sentinels = 1 + sum(1 for request in pending if request.command[0] == GET_MOTOR_SETTINGS)
+            self.sentinelDeadline = now + self.timeout
+            self.timeouts += 1
+            self.resyncs += 1
+        for request in pending:
+            if not request.future.done():
+                request.future.set_exception(CommandTimeout('No reply to %s (request %d)' %
+                                                            (request.command, request.requestId)))
+        self.sock.sendObject((GET_MOTOR_SETTINGS,))
+
+    def failPending(self, error):
+        with self.lock:
+            pending = list(self.pending)
+            self.pending.clear()
+        for request in pending:
+            if not request.future.done():
+                request.future.set_exception(error)
+        # Requests not sent yet fail too
+        while True:
+            try:
+                item = self.outbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.outbox.put(None)
+                break
+            if item[1] is not None and not item[1].done():
+                item[1].set_exception(error)
@@ -0,0 +1,97 @@
+import queue
+import heapq
+import threading
+import traceback
+
+# Frame processing pipeline
+# The receiver (ImageThread.run) only drains the socket and submits (header, payload)
+# jobs into a bounded queue. When the queue is full the receiver blocks, so the Pi
+# sees TCP back pressure instead of the GUI running out of memory.
+# A pool of worker threads runs the processing (cv2 releases the GIL while decoding,
+# merging, resizing and writing), and a reorder thread hands the results back in the
+# order they were received, which is the header['count'] order sent by the Pi.
+# A job may produce no result (eg. first exposures of a bracket), the reorder stage
+# simply skips it.
+
+
+class FramePipeline:
+
+    def __init__(self, process, emit, workers=2, queueSize=8):
+        self.process = process      # process(header, payload) -> result or None, called by the workers
+        self.emit = emit            # emit(result), called in order by the reorder thread
+        self.workers = max(1, workers)
+        self.queueSize = max(1, queueSize)
+        self.jobQueue = None
+        self.resultQueue = None
+        self.threads = []
+        self.reorderThread = None
+        self.seq = 0
+        self.running = False
+
+    def start(self):
+        self.jobQueue = queue.Queue(maxsize=self.queueSize)
+        self.resultQueue = queue.Queue()
+        self.seq = 0
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name='FrameWorker%d' % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.reorderThread = threading.Thread(target=self.reorder, name='FrameReorder', daemon=True)
+        self.reorderThread.start()
+        self.running = True
+
+# Called from the receiver only, blocks while the queue is full
+    def submit(self, header, payload):
+        self.jobQueue.put((self.seq, header, payload))
+        self.seq += 1
+
+    def queueDepth(self):
+        if self.jobQueue is None:
+            return 0
+        return self.jobQueue.qsize()
+
+# Process what is already queued then stop the workers and the reorder thread
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        for _ in self.threads:
+            self.jobQueue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.resultQueue.put(None)
+        self.reorderThread.join()
+        self.threads = []
+
+    def work(self):
+        while True:
+            job = self.jobQueue.get()
+            if job is None:
+                break
+            seq, header, payload = job
+            result = None
+            try:
+                result = self.process(header, payload)
+            except Exception:
+                traceback.print_exc()
+            # Always post, a missing sequence number would block the reorder stage
+            self.resultQueue.put((seq, result))
+
+    def reorder(self):
+        pending = []
+        nextSeq = 0
+        while True:
+            item = self.resultQueue.get()
+            if item is None:
+                break
+            heapq.heappush(pending, item)
+            while pending and pending[0][0] == nextSeq:
+                seq, result = heapq.heappop(pending)
+                nextSeq += 1
+                if result is None:
+                    continue
+                try:
+                    self.emit(result)
+                except Exception:
+                    traceback.print_exc()
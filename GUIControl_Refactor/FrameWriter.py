@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import queue
+import threading
+import traceback
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append('../Common')
+from Constants import *
+
+# Background disk writer for the captured frames
+# The frame workers only queue the files: received Jpeg bytes are queued as is,
+# decoded images are Jpeg encoded by a small pool (cv2.imencode releases the GIL).
+# One writer thread writes the files in queue order, in batches of what is pending.
+# The queue is bounded: when the disk is slower than the capture, the frame workers
+# and then the receiver are blocked instead of memory growing.
+# Directories are created once, the first time a file is written to them.
+# Bytes may come with a release function called once they are written (leased receive buffer).
+# fsync policy:
+#   FSYNC_NONE  : the OS writes back when it wants
+#   FSYNC_FRAME : each file is synced before the next one is written
+#   FSYNC_CLIP  : files are synced when the writer is flushed (end of clip) or stopped
+
+
+class FrameWriter:
+    batchSize = 16
+
+    def __init__(self, queueSize=32, encoders=2, fsync=FSYNC_NONE):
+        self.queueSize = max(1, queueSize)
+        self.encoders = max(1, encoders)
+        self.fsync = fsync
+        self.writeQueue = None
+        self.encoder = None
+        self.thread = None
+        self.directories = set()
+        self.unsynced = []
+        self.running = False
+        # Counters
+        self.filesWritten = 0
+        self.bytesWritten = 0
+        self.errors = 0
+        self.rate = 0.  # MB/s over the last second
+        self.rateLock = threading.Lock()  # Updated by the writer thread and by statusText
+        self.rateBytes = 0
+        self.rateStart = time.time()
+
+    def start(self):
+        self.writeQueue = queue.Queue(maxsize=self.queueSize)
+        self.encoder = ThreadPoolExecutor(max_workers=self.encoders, thread_name_prefix='FrameEncoder')
+        self.thread = threading.Thread(target=self.run, name='FrameWriter', daemon=True)
+        self.thread.start()
+        self.running = True
+
+# Write what is queued then stop
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.writeQueue.put(None)
+        self.thread.join()
+        self.encoder.shutdown(wait=True)
+        self.syncFiles()
+
+# A new clip: directories may have changed, sync the previous clip
+    def newClip(self):
+        if self.running:
+            self.writeQueue.put(('clip', None, None, None))
+        else:
+            self.directories = set()
+
+    def queueDepth(self):
+        if self.writeQueue is None:
+            return 0
+        return self.writeQueue.qsize()
+
+# Write bytes (a received Jpeg), blocks while the queue is full
+# release: called when data is no longer used
+    def writeBytes(self, path, data, release=None):
+        self.writeQueue.put(('bytes', path, data, release))
+
+# Encode an image in the pool then write it, blocks while the queue is full
+    def writeImage(self, path, image):
+        future = self.encoder.submit(cv2.imencode, os.path.splitext(path)[1], image)
+        self.writeQueue.put(('image', path, future, None))
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.writeQueue.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.writeQueue.get_nowait())
+                except queue.Empty:
+                    break
+            written = 0
+            for item in batch:
+                if item is None:
+                    stopping = True
+                    continue
+                kind, path, data, release = item
+                if kind == 'clip':
+                    self.syncFiles()
+                    self.directories = set()
+                    continue
+                try:
+                    if kind == 'image':
+                        ok, data = data.result()
+                        if not ok:
+                            raise IOError('Cannot encode ' + path)
+                    written += self.writeFile(path, data)
+                except Exception:
+                    self.errors += 1
+                    traceback.print_exc()
+                finally:
+                    if release is not None:
+                        release()
+            self.updateRate(written)
+
+    def writeFile(self, path, data):
+        directory = os.path.dirname(path)
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+        with open(path, 'wb') as file:
+            file.write(data)
+            if self.fsync == FSYNC_FRAME:
+                file.flush()
+                os.fsync(file.fileno())
+        if self.fsync == FSYNC_CLIP:
+            self.unsynced.append(path)
+        size = len(memoryview(data).cast('B'))
+        self.filesWritten += 1
+        self.bytesWritten += size
+        return size
+
+    def syncFiles(self):
+        for path in self.unsynced:
+            try:
+                with open(path, 'rb+') as file:
+                    os.fsync(file.fileno())
+            except OSError:
+                self.errors += 1
+                traceback.print_exc()
+        self.unsynced = []
+
+# Called after each batch and by statusText, so the rate drops to 0 while nothing is written
+    def updateRate(self, written=0):
+        with self.rateLock:
+            self.rateBytes += written
+            now = time.time()
+            elapsed = now - self.rateStart
+            if elapsed >= 1.:
+                self.rate = self.rateBytes / elapsed / 1000000.
+                self.rateBytes = 0
+                self.rateStart = now
+            return self.rate
+
+    def statusText(self):
+        return 'write {0:.1f} MB/s q {1} errors {2}'.format(self.updateRate(), self.queueDepth(), self.errors)
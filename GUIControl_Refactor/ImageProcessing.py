@@ -0,0 +1,386 @@
+import os
+import numpy as np
+import cv2
+
+# Image processing helpers used by the image thread workers
+# No Qt here so they can be used by the merge processes and the benchmarks
+
+
+# Subsampled copy of image with about samples pixels (nearest neighbour: pixels are picked, not averaged)
+def thumbnail(image, samples):
+    height, width = image.shape[:2]
+    if samples <= 0 or height * width <= samples:
+        return image
+    scale = np.sqrt(samples / (height * width))
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return cv2.resize(image, dsize=size, interpolation=cv2.INTER_NEAREST)
+
+
+# Histograms of the b, g, r channels plus luma for exposure monitoring
+# The full frame is read once to pick about samples pixels (0 for all the pixels),
+# the four histograms are then computed on this small cache resident thumbnail
+# Returns four (256, 1) float32 arrays like cv2.calcHist: b, g, r, luma
+def calcHistograms(image, samples=250000):
+    sub = thumbnail(image, samples)
+    histos = []
+    for i in range(3):
+        histos.append(cv2.calcHist([sub], [i], None, [256], [0, 256]))
+    luma = cv2.cvtColor(sub, cv2.COLOR_BGR2GRAY)
+    histos.append(cv2.calcHist([luma], [0], None, [256], [0, 256]))
+    return histos
+
+
+# Flat field calibration table in its compact form: float32 gains at the image resolution
+def prepareCalibrationTable(table, shape):
+    table = np.asarray(table, dtype=np.float32)
+    if table.shape[:2] != tuple(shape[:2]):
+        table = cv2.resize(table, dsize=(shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+    return np.ascontiguousarray(table)
+
+
+# Apply the gains to an uint8 image in one saturating multiply, no float temporaries
+# out may be image itself (in place)
+def applyCalibration(image, table, out=None):
+    return cv2.multiply(image, table, out, 1., cv2.CV_8U)
+
+
+# Flat field from several frames, accumulated without keeping the frames
+# Running mean and variance per pixel (Welford) in float32, processed by bands of rows
+# so the float temporaries stay small.
+# Outlier rejection:
+#   pixel : a pixel further than rejectSigma standard deviations from the running mean (dust, hair)
+#           is not accumulated for this frame
+#   frame : a frame with more than maxOutliers outlier pixels, or whose mean level moved by more
+#           than maxLevelChange (lamp flicker, film moved) is rejected as a whole
+# There is no running mean yet for the first warmup frames: they are kept, then checked the
+# same way against their per pixel median (a speck in one of them is not in the median,
+# warmup must be 3 or more for that) and a noise level measured on the difference of two of them.
+# gains raises ValueError with fewer than minFrames accepted frames: there is no flat to divide by.
+class FlatFieldAccumulator:
+    bandRows = 256
+    noiseSamples = 250000  # Pixels sampled to measure the noise of the warmup frames
+
+    def __init__(self, shape, rejectSigma=4., minSigma=1., maxOutliers=0.05, maxLevelChange=0.1, warmup=3, minFrames=1):
+        self.shape = tuple(shape)
+        self.rejectSigma = rejectSigma
+        self.minSigma = minSigma  # Floor of the standard deviation, in 8 bits levels
+        self.maxOutliers = maxOutliers
+        self.maxLevelChange = maxLevelChange
+        self.warmup = warmup
+        self.minFrames = max(1, minFrames)
+        self.mean = np.zeros(self.shape, np.float32)
+        self.m2 = np.zeros(self.shape, np.float32)
+        self.count = np.zeros(self.shape[:2], np.uint16)
+        self.outliers = np.zeros(self.shape[:2], np.bool_)
+        self.frames = 0  # Accepted frames
+        self.rejected = 0
+        self.level = 0.  # Mean level of the accepted frames
+        self.warmupFrames = []  # Copies of the first frames, None once they are checked
+
+    def bands(self):
+        for top in range(0, self.shape[0], self.bandRows):
+            yield slice(top, min(top + self.bandRows, self.shape[0]))
+
+# Returns True if the frame was accumulated
+# A warmup frame is accepted for now, it may be rejected once the warmup frames are checked
+    def add(self, image):
+        if image.shape != self.shape:
+            raise ValueError('Calibration frame size changed')
+        if self.warmupFrames is not None:
+            self.warmupFrames.append(image.copy())
+            if len(self.warmupFrames) >= self.warmup:
+                self.addWarmupFrames()
+            return True
+        level = frameLevel(image)
+        if abs(level - self.level) > self.maxLevelChange * max(self.level, 1.):
+            self.rejected += 1
+            return False
+        # Pass 1: outlier pixels of this frame
+        # With few frames the per pixel deviation is noisy, it is floored by the channel noise
+        degrees = max(float(np.sum(self.count, dtype=np.int64)) - self.count.size, 1.)
+        floor = np.sqrt(np.sum(self.m2, axis=(0, 1), dtype=np.float64) / degrees).astype(np.float32)
+        floor = np.maximum(floor, self.minSigma)
+        for band in self.bands():
+            x = image[band].astype(np.float32)
+            n = self.count[band].astype(np.float32)[..., None]
+            variance = self.m2[band] / np.maximum(n - 1, 1)
+            sigma = np.sqrt(np.maximum(variance, floor * floor) * (1. + 1. / np.maximum(n, 1)))
+            np.any(np.abs(x - self.mean[band]) > self.rejectSigma * sigma, axis=2, out=self.outliers[band])
+        if np.count_nonzero(self.outliers) > self.maxOutliers * self.outliers.size:
+            self.rejected += 1
+            return False
+        self.accumulate(image, level)
+        return True
+
+# Check the warmup frames against their per pixel median, then accumulate them
+    def addWarmupFrames(self):
+        frames, self.warmupFrames = self.warmupFrames, None
+        if not frames:
+            return
+        levels = [frameLevel(image) for image in frames]
+        referenceLevel = float(np.median(levels))
+        sigma = np.full(3, self.minSigma, np.float32)
+        if len(frames) > 1:
+            # Robust noise: median absolute difference of two frames, sampled at the same pixels
+            a = thumbnail(frames[0], self.noiseSamples).astype(np.float32)
+            b = thumbnail(frames[1], self.noiseSamples).astype(np.float32)
+            noise = 1.4826 / np.sqrt(2.) * np.median(np.abs(a - b).reshape(-1, 3), axis=0)
+            sigma = np.maximum(noise, self.minSigma).astype(np.float32)
+        limit = self.rejectSigma * sigma * np.sqrt(1. + 1. / len(frames))
+        reference = np.empty(self.shape, np.float32)
+        for band in self.bands():
+            reference[band] = np.median(np.stack([image[band] for image in frames]), axis=0)
+        for image, level in zip(frames, levels):
+            if abs(level - referenceLevel) > self.maxLevelChange * max(referenceLevel, 1.):
+                self.rejected += 1
+                continue
+            if len(frames) > 1:
+                for band in self.bands():
+                    x = image[band].astype(np.float32)
+                    np.any(np.abs(x - reference[band]) > limit, axis=2, out=self.outliers[band])
+                if np.count_nonzero(self.outliers) > self.maxOutliers * self.outliers.size:
+                    self.rejected += 1
+                    continue
+            else:
+                self.outliers[...] = False
+            self.accumulate(image, level)
+
+# Pass 2: masked running mean and variance, the pixels in self.outliers are left out
+    def accumulate(self, image, level):
+        for band in self.bands():
+            x = image[band].astype(np.float32)
+            accept = ~self.outliers[band]
+            count = self.count[band]
+            count += accept
+            n = np.maximum(count, 1).astype(np.float32)[..., None]
+            delta = x - self.mean[band]
+            delta *= accept[..., None]
+            self.mean[band] += delta / n
+            delta *= x - self.mean[band]
+            self.m2[band] += delta
+        self.level = (self.level * self.frames + level) / (self.frames + 1)
+        self.frames += 1
+
+# Normalize each channel toward its mean: gains = centre / flat
+    def gains(self):
+        if self.warmupFrames is not None:
+            self.addWarmupFrames()  # Fewer frames than warmup
+        if self.frames < self.minFrames:
+            raise ValueError('%d calibration frames accepted, %d rejected' % (self.frames, self.rejected))
+        centre = np.mean(self.mean, axis=(0, 1)).astype(np.float32)
+        return centre / np.maximum(self.mean, 1.)
+
+
+# Mean level of a bgr frame
+def frameLevel(image):
+    return float(np.mean(cv2.mean(image)[:3]))
+
+
+# Calibration table file: float16 .npy, small
+# Written to a temporary file swapped in at once, a failed save keeps the previous table
+def saveCalibrationTable(path, table):
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        np.save(file, np.asarray(table, dtype=np.float16))
+    os.replace(temporary, path)
+
+
+# Loaded in memory, not mapped: a mapped file could not be replaced on Windows
+def loadCalibrationTable(path):
+    return np.load(path)
+
+
+# Lens analysis profiles through the centre of a bgr image, each one an (n, 3) uint8 array
+# The diagonal goes from the top left to the bottom right corner, one sample per column
+def lensProfiles(image):
+    height, width = image.shape[:2]
+    columns = np.arange(width)
+    rows = (columns * (height / width)).astype(np.intp)
+    return [('Horizontal', image[height // 2, :, :].copy()),
+            ('Vertical', image[:, width // 2, :].copy()),
+            ('Diagonal', image[rows, columns, :])]
+
+
+# Focus map: Laplacian variance of each tile of a rows x cols grid, in one vectorized pass
+# INTER_AREA resizing of the Laplacian and of its square box filters each tile:
+# variance = mean(L^2) - mean(L)^2
+def focusMap(image, rows=6, cols=8):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+    mean = cv2.resize(laplacian, dsize=(cols, rows), interpolation=cv2.INTER_AREA)
+    square = cv2.resize(laplacian * laplacian, dsize=(cols, rows), interpolation=cv2.INTER_AREA)
+    return np.maximum(square - mean * mean, 0.)
+
+
+# Heatmap of the focus map blended over a width pixels wide copy of the image, rgb for the GUI
+# Each tile shows its score in percent of the sharpest tile
+def focusMapOverlay(image, scores, width=800, alpha=0.4):
+    height = int(image.shape[0] * width / image.shape[1])
+    small = cv2.resize(image, dsize=(width, height), interpolation=cv2.INTER_AREA)
+    top = max(float(np.max(scores)), 1e-6)
+    levels = np.clip(scores / top * 255., 0, 255).astype(np.uint8)
+    heat = cv2.applyColorMap(cv2.resize(levels, dsize=(width, height), interpolation=cv2.INTER_NEAREST),
+                             cv2.COLORMAP_JET)
+    overlay = cv2.addWeighted(small, 1. - alpha, heat, alpha, 0.)
+    rows, cols = scores.shape
+    for r in range(rows):
+        for c in range(cols):
+            x = int((c + 0.3) * width / cols)
+            y = int((r + 0.55) * height / rows)
+            cv2.putText(overlay, '%d' % round(100. * scores[r, c] / top), (x, y),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+    return cv2.cvtColor(overlay, cv2.COLOR_BGR2RGB)
+
+
+# Live sharpness: Laplacian variance of the centre roi (fraction of the width and height),
+# optionally reduced by reduce, in float32
+def sharpnessMetric(image, roi=0.5, reduce=1):
+    height, width = image.shape[:2]
+    h = max(1, int(height * roi))
+    w = max(1, int(width * roi))
+    top = (height - h) // 2
+    left = (width - w) // 2
+    crop = image[top:top + h, left:left + w]
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    if reduce > 1:
+        gray = cv2.resize(gray, dsize=(max(1, w // reduce), max(1, h // reduce)), interpolation=cv2.INTER_AREA)
+    mean, stddev = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_32F))
+    return float(stddev[0, 0] ** 2)
+
+
+# Focus peaking: copy of image with the strong edges painted red
+def focusPeaking(image, threshold=40):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    edges = cv2.convertScaleAbs(cv2.Laplacian(gray, cv2.CV_16S)) > threshold
+    peaked = image.copy()
+    peaked[edges] = (0, 0, 255)
+    return peaked
+
+
+# Merged float32 image to uint8 in one saturating pass, calibrated if table is given
+# normalize: min/max normalize first (Mertens), in place, else the image is already 0..1
+# out: optional uint8 buffer to write into
+def finishMerge(image, table=None, out=None, normalize=False):
+    scale = 255.
+    if normalize:
+        if table is None:
+            return cv2.normalize(image, out, 0., 255., cv2.NORM_MINMAX, cv2.CV_8U)
+        cv2.normalize(image, image, 0., 255., cv2.NORM_MINMAX)
+        scale = 1.
+    if table is not None:
+        return cv2.multiply(image, table, out, scale, cv2.CV_8U)
+    return cv2.convertScaleAbs(image, out, scale)
+
+
+# Index of the longest exposure of a bracket set that is not clipped
+# (fraction of the pixels at or above clip under maxClipped), else the least clipped one
+def usableExposure(images, shutters, clip=250, maxClipped=0.02, samples=50000):
+    best, bestClipped = 0, 2.
+    for i in sorted(range(len(images)), key=lambda i: shutters[i], reverse=True):
+        sub = thumbnail(images[i], samples)
+        clipped = np.count_nonzero(sub.max(axis=2) >= clip) / float(sub.shape[0] * sub.shape[1])
+        if clipped <= maxClipped:
+            return i
+        if clipped < bestClipped:
+            best, bestClipped = i, clipped
+    return best
+
+
+# Tiled Mertens merge
+# cv2 MergeMertens keeps float32 weight maps and pyramids of every exposure for the whole
+# frame at once. Merging overlapping tiles caps that to a tile, the overlaps are blended
+# with complementary linear ramps so the weights always sum to 1 (no seam, no weight buffer).
+# A tile pyramid is not as deep as the frame one, so each tile keeps its details and takes
+# its low frequencies from a merge of the whole frame at 1/lowFactor (cheap): without it
+# the tiles differ in tone, by about 30 levels on average, with it by about 1.
+# The raw Mertens output is not normalized per tile: normalize the whole frame after
+MERTENS_BYTES_PER_PIXEL = 30  # MergeMertens temporaries per tile pixel and exposure, measured on 12MP
+
+
+# Side of the square tiles that keep the temporaries of a merge of count exposures within
+# budget bytes (the exposures and the output frame are not counted)
+def mertensTileSize(count, budget, overlap=64):
+    side = int(np.sqrt(budget / float(MERTENS_BYTES_PER_PIXEL * max(1, count))))
+    return max(side, 4 * overlap)
+
+
+# Tiles along an axis: [(start, end, weights), ...], consecutive tiles overlap by overlap
+def tileRanges(length, tile, overlap):
+    if length <= tile:
+        return [(0, length, np.ones(length, np.float32))]
+    n = int(np.ceil((length - overlap) / float(tile - overlap)))
+    tile = int(np.ceil((length + (n - 1) * overlap) / float(n)))  # Same size tiles
+    step = tile - overlap
+    ramp = ((np.arange(overlap) + 0.5) / overlap).astype(np.float32)
+    ranges = []
+    for i in range(n):
+        start = i * step
+        end = min(length, start + tile)
+        weights = np.ones(end - start, np.float32)
+        if i > 0:
+            weights[:overlap] = ramp
+        if i < n - 1:
+            weights[-overlap:] = ramp[::-1]  # 1 - ramp of the next tile
+        ranges.append((start, end, weights))
+    return ranges
+
+
+# Merge images (uint8 exposures) into out (float32, raw Mertens output) tile by tile
+def tiledMertens(mergeMertens, images, out, tileSize, overlap=64, lowFactor=32):
+    height, width = images[0].shape[:2]
+    lowSize = (-(-width // lowFactor), -(-height // lowFactor))
+    low = mergeMertens.process([cv2.resize(image, lowSize, interpolation=cv2.INTER_AREA) for image in images])
+    out[...] = 0
+    for y0, y1, wy in tileRanges(height, tileSize, overlap):
+        for x0, x1, wx in tileRanges(width, tileSize, overlap):
+            tile = mergeMertens.process([image[y0:y1, x0:x1] for image in images])
+            # Low frequencies of the whole frame merge instead of the tile ones
+            tileLow = cv2.resize(tile, (-(-(x1 - x0) // lowFactor), -(-(y1 - y0) // lowFactor)),
+                                 interpolation=cv2.INTER_AREA)
+            frameLow = cv2.getRectSubPix(low, (tileLow.shape[1], tileLow.shape[0]),
+                                         ((x0 + x1) / 2. / lowFactor - 0.5, (y0 + y1) / 2. / lowFactor - 0.5))
+            tile += cv2.resize(frameLow - tileLow, (x1 - x0, y1 - y0), interpolation=cv2.INTER_LINEAR)
+            out[y0:y1, x0:x1] += tile * np.outer(wy, wx)[:, :, np.newaxis]
+    return out
+
+
+# Bracket alignment (film weave between the exposures) with median threshold bitmaps
+# The shift is found on the frame reduced by reduce, then refined at full size on a centre
+# crop. coarse and fine are cv2 AlignMTB objects: their bitmaps do not depend on the exposure
+# Returns the (dx, dy) to apply to each exposure to align it on images[reference]
+def bracketShifts(coarse, fine, images, reference, reduce=4, crop=1024):
+    height, width = images[0].shape[:2]
+    size = (max(1, width // reduce), max(1, height // reduce))
+    grays = [cv2.cvtColor(cv2.resize(image, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+             for image in images]
+    shifts = []
+    for i, image in enumerate(images):
+        if i == reference:
+            shifts.append((0, 0))
+            continue
+        dx, dy = coarse.calculateShift(grays[reference], grays[i])
+        dx, dy = dx * reduce, dy * reduce
+        cropWidth = min(crop, width - 2 * abs(dx))
+        cropHeight = min(crop, height - 2 * abs(dy))
+        if reduce > 1 and cropWidth >= 64 and cropHeight >= 64:
+            x0, y0 = (width - cropWidth) // 2, (height - cropHeight) // 2
+            a = cv2.cvtColor(images[reference][y0:y0 + cropHeight, x0:x0 + cropWidth], cv2.COLOR_BGR2GRAY)
+            b = cv2.cvtColor(image[y0 - dy:y0 - dy + cropHeight, x0 - dx:x0 - dx + cropWidth], cv2.COLOR_BGR2GRAY)
+            rx, ry = fine.calculateShift(a, b)
+            dx, dy = dx + rx, dy + ry
+        shifts.append((dx, dy))
+    return shifts
+
+
+# Translate the exposures by their shifts, borders replicated (an integer shift is a copy)
+def alignImages(images, shifts):
+    aligned = []
+    for image, (dx, dy) in zip(images, shifts):
+        if dx == 0 and dy == 0:
+            aligned.append(image)
+            continue
+        flags = cv2.INTER_NEAREST if float(dx).is_integer() and float(dy).is_integer() else cv2.INTER_LINEAR
+        matrix = np.float32([[1, 0, dx], [0, 1, dy]])
+        aligned.append(cv2.warpAffine(image, matrix, (image.shape[1], image.shape[0]),
+                                      flags=flags, borderMode=cv2.BORDER_REPLICATE))
+    return aligned
@@ -3,44 +3,89 @@ import cv2
 import sys
 import os
 import time
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-#import matplotlib offscreen
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+# Optional libjpeg-turbo backend for the scaled preview decode
+try:
+    from turbojpeg import TurboJPEG
+except ImportError:
+    TurboJPEG = None
 
 from PyQt5.QtCore import QThread, pyqtSignal
 sys.path.append('../Common')
 from Constants import *
 from MessageSocket import *
+from FramePipeline import FramePipeline
+from MergeEngine import MergeEngine
+from FrameWriter import FrameWriter
+from BracketAssembler import BracketAssembler
+from ImageProcessing import *
 
 # Receive and process header and images
 # N on concluding experiments
 #   linearize = true : Revert gamma corection of Jpeg before merging
 #   crf = True : Precalculate the camera response forDebevec merge
 # It seems that the Debevec merge without the camera response (ie a linear response) gives the best result
+# The camera response is now estimated once per camera/mode on the first debevecResponseSets bracket sets,
+# cached in response.npz and reused by every Debevec merge (linear response until it is known)
 # it seems also that Durand's Tonemap gives the best result
 # Note: sharpness is useful for focusing
 # Focus your lens to have the maximum sharpness
+# The thread itself only receives, frames are processed by a FramePipeline worker pool
+# and emitted to the GUI in count order
+# Bracket sets are merged by a MergeEngine process pool (mergeProcesses = 0 merges in the worker)
+# Saved frames are written by a background FrameWriter
+# Passthrough: straight Jpeg captures are saved without decoding, only a sample is decoded for display
+# The preview is latest wins: only the newest processed frame is kept for the GUI, older ones are dropped
+# Preview only frames with a reduce factor of 2, 4 or 8 are decoded DCT scaled (no full decode + resize)
+
+# Reduce factors the Jpeg decoder can scale to
+REDUCED_DECODE = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
 
 
 class ImageThread (QThread):
     threadRunning = False
-    imageSignal = pyqtSignal([object, ])   # Signal to the GUI display image
+    previewSignal = pyqtSignal()   # Signal to the GUI a new preview (image, histos) can be taken
     headerSignal = pyqtSignal([object, ])  # Signal to the GUI display header
-    plotSignal = pyqtSignal([object, ])  # Signal to the GUI display analyze
-    histogramSignal = pyqtSignal([object, ])  # Signal to the GUI: histogram
-    statusSignal = pyqtSignal()  # Signal to the GUI to display image thread info
+    plotSignal = pyqtSignal([object, ])  # Signal to the GUI display analyze: [(title, profile), ...]
+    focusSignal = pyqtSignal([object, ])  # Signal to the GUI display analyze: focus map heatmap (rgb)
     merge = MERGE_NONE
     brackets = 1
     sharpness = False
     # saveToFile = False
     histos = False
-    images = []
-    shutters = []
+    workers = 4  # Frame processing threads
+    queueSize = 8  # Received frames waiting for a worker
+    mergeProcesses = 4  # HDR merge processes, 0 to merge in the frame workers
+    alignBrackets = False  # Align the exposures of a bracket set before merging them (film weave)
+    alignReduce = 4  # Alignment: coarse shift on the frame reduced by alignReduce, refined at full size
+    mergeMemoryBudget = 0  # MB of temporaries per Mertens merge, tiled merge if the frame needs more, 0 for no limit
+    writerQueueSize = 32  # Frames waiting to be written
+    writerEncoders = 2  # Jpeg encoding threads for merged/calibrated frames
+    fsyncPolicy = FSYNC_NONE
+    passthrough = False  # Save straight Jpeg captures without decoding them
+    passthroughEvery = 10  # Decode for display one frame out of passthroughEvery
+    passthroughInterval = 0.  # or at most one frame every passthroughInterval seconds if > 0
+    histogramSamples = 250000  # Pixels sampled for the histograms, 0 for all
+    debevecResponseSets = 3  # Bracket sets used to estimate the Debevec camera response
+    sharpnessRoi = 0.5  # Live sharpness: centre fraction of the frame
+    sharpnessReduce = 1  # Live sharpness: reduction of the roi before the Laplacian
+    focusPeaking = False  # Paint the sharp edges of the preview
+    focusPeakingThreshold = 40
+    focusTiles = (6, 8)  # Lens analysis focus map grid (rows, cols)
+    bracketSetMargin = 2  # Bracket set buffers beyond what the workers and the background merges hold, see run
+    bracketTimeout = 5.  # Seconds before an incomplete bracket set is dropped
+    previewMerge = PREVIEW_MERGE_NONE  # Preview of the bracket sets: full merge, reduced merge or one exposure
+    previewMergeReduce = 4  # Reduced preview merge: at least 1/previewMergeReduce of the full size
+    backgroundMerges = 2  # Full resolution merges of the saved frames running behind the preview
+    calibrationRejectSigma = 4.  # Local calibration: pixel outlier threshold in standard deviations
+    calibrationMinFrames = 1  # Local calibration: accepted frames needed to replace the table
+    previewEnabled = True  # False while the preview window is hidden or minimized
     startframe = 1
     currentframe = 1
-    captureStatusInfo = ""
 
     def __init__(self, ip_pi):
         QThread.__init__(self)
@@ -49,14 +94,29 @@ class ImageThread (QThread):
         self.window = None
         self.saveOn = False
         self.startframe = 1
-        self.mergeMertens = cv2.createMergeMertens(1, 1, 1)
-#         self.mergeMertens = cv2.createMergeMertens()
-#         print("Contrast:",self.mergeMertens.getContrastWeight())
-#         print("Saturation:",self.mergeMertens.getSaturationWeight())
-#         print("Exposure:",self.mergeMertens.getExposureWeight())
-        self.mergeDebevec = cv2.createMergeDebevec()
-        self.calibrateDebevec = cv2.createCalibrateDebevec()
-        self.toneMap = cv2.createTonemapReinhard()
+        self.pipeline = None
+        self.mergeEngine = None
+        self.writer = None
+        self.saveMerger = None  # Background full resolution merges, see saveMergeInBackground
+        self.saveMergeSlots = None
+        self.bufferPool = None  # Received Jpegs, see run
+        self.mergeLocal = threading.local()  # cv2 merge objects, one set per worker
+        self.assembler = BracketAssembler(self.bracketSetMargin, self.bracketTimeout, self.bracketEvicted)
+        self.sampleLock = threading.Lock()
+        self.lastSample = 0.
+        self.previewLock = threading.Lock()
+        self.previewFrame = None  # Newest (image, histos) not yet taken by the GUI
+        self.previewScheduled = False
+        self.droppedPreviews = 0
+        self.sharpnessHistory = deque(maxlen=300)  # (count, sharpness) in count order, for the GUI
+        self.stageLock = threading.Lock()
+        self.stageTimes = {}  # Stage name -> smoothed time in seconds, see recordStage
+        self.turboJpeg = None
+        if TurboJPEG is not None:
+            try:
+                self.turboJpeg = TurboJPEG()
+            except (Exception, BaseException):
+                pass  # libturbojpeg not found, use opencv
 #        self.claheProc = cv2.createCLAHE(clipLimit=1, tileGridSize=(8,8))
 #        self.simpleWB = cv2.xphoto.createSimpleWB()
 #        self.simpleWB = cv2.xphoto.createGrayworldWB()
@@ -75,12 +135,27 @@ class ImageThread (QThread):
         self.hflip = False
         self.vflip = False
         self.table = None
+        self.calibrationTables = {}  # (height, width) -> float32 table, see calibrationTable
+        self.calibrationLock = threading.Lock()
         self.doCalibrate = False
+        self.flatField = None  # FlatFieldAccumulator while calibrating
+        self.responseLock = threading.Lock()
+        self.responses = {}  # Debevec camera responses by camera/mode, see setCamera
+        self.responseKey = None
+        self.responseSets = []  # Responses of the sets measured for responseKey
         try:
-            npz = np.load("calibrate.npz")
-            self.table = npz['table']
+            npz = np.load("response.npz")
+            self.responses = {k: npz[k] for k in npz.files}
         except (Exception, BaseException):
             pass
+        try:
+            self.table = loadCalibrationTable("calibrate.npy")
+        except (Exception, BaseException):
+            try:
+                npz = np.load("calibrate.npz")  # Previous single frame format
+                self.table = npz['table']
+            except (Exception, BaseException):
+                pass
         self.threadRunning = True
 
 #     def simplest_cb(self, img, percent):
@@ -95,64 +170,328 @@ class ImageThread (QThread):
 #             out_channels.append(cv2.LUT(channel, lut))
 #         return cv2.merge(out_channels)
 
+# b, g, r and luma histograms on a subsample of the image
     def calcHistogram(self, image):
-        histos = []
-        for i in range(3):
-            histo = cv2.calcHist([image], [i], None, [256], [0, 256])
-            histos.append(histo)
-        self.displayHistogramOverImage(histos, image)
-        
-    def displayHistogramOverImage(self, histos, image):
-        # PSI: pyplot is not threadsafe -> moving plot code to main
-        # figure = plt.figure()
-        # axe = figure.add_subplot(111)
-        # colors = ('b', 'g', 'r')
-        # for i, col in enumerate(colors):
-        #     axe.plot(histos[i], color=col)
-        # axe.set_xlim([0, 256])
-        # axe.get_yaxis().set_visible(False)
-        # figure.tight_layout()
-        # figure.canvas.draw()
-        # canvasWidth, canvasHeight = figure.canvas.get_width_height()
-        # buf = np.fromstring(figure.canvas.tostring_rgb(), dtype=np.uint8).reshape(canvasHeight, canvasWidth, 3)
-        # plt.close()
-        # self.plotSignal.emit(buf)  # «display plot in the GUI
-        self.histogramSignal.emit(histos)
-#         ww = int(image.shape[0]/4)
-#         hh = int(h*ww/w)
-#         resized = cv2.resize(buf, dsize=(ww,hh), interpolation=cv2.INTER_CUBIC)
-#         image[:hh,:ww] = resized
-
-
-    def processImage(self, header, jpeg):
+        return calcHistograms(image, self.histogramSamples)
+
+
+# Calibration table prepared once per resolution (float32, resized if needed)
+    def calibrationTable(self, shape):
+        key = tuple(shape[:2])
+        with self.calibrationLock:
+            table = self.calibrationTables.get(key)
+            if table is None and self.table is not None:
+                table = prepareCalibrationTable(self.table, shape)
+                self.calibrationTables[key] = table
+        return table
+
+# Camera opened: select the cached Debevec response for this camera version and sensor mode
+    def setCamera(self, version, mode):
+        with self.responseLock:
+            self.responseKey = 'V%s_mode%s' % (version, mode)
+            self.responseSets = []
+
+# Display scale 1/factor, set by the GUI at any time: the workers read it once per frame
+    def setReduceFactor(self, factor):
+        factor = int(factor)
+        if factor < 1:
+            raise ValueError('Reduce factor %d, must be 1 or more' % factor)
+        self.reduceFactor = factor
+
+    def responseCurve(self):
+        with self.responseLock:
+            return self.responses.get(self.responseKey)
+
+# Until the response is cached, estimate it on complete Debevec sets
+# The responses of debevecResponseSets sets are averaged (geometric mean) then saved
+    def estimateResponse(self, images, times):
+        with self.responseLock:
+            key = self.responseKey
+            if key is None or key in self.responses or len(self.responseSets) >= self.debevecResponseSets:
+                return
+        response = self.mergers().calibrateDebevec.process(images, times)
+        with self.responseLock:
+            if key != self.responseKey or key in self.responses:
+                return
+            self.responseSets.append(response)
+            if len(self.responseSets) < self.debevecResponseSets:
+                return
+            logs = np.log(np.maximum(np.stack(self.responseSets), 1e-6))
+            self.responses[key] = np.exp(np.mean(logs, axis=0)).astype(np.float32)
+            self.responseSets = []
+            np.savez('response.npz', **self.responses)
+        header = {'type': HEADER_MESSAGE, 'msg': "Debevec camera response saved for " + key}
+        self.headerSignal.emit(header)
+
+# cv2 algorithms are not shared between the worker threads
+    def mergers(self):
+        local = self.mergeLocal
+        if not hasattr(local, 'mergeMertens'):
+            local.mergeMertens = cv2.createMergeMertens(1, 1, 1)
+#             local.mergeMertens = cv2.createMergeMertens()
+#             print("Contrast:",local.mergeMertens.getContrastWeight())
+#             print("Saturation:",local.mergeMertens.getSaturationWeight())
+#             print("Exposure:",local.mergeMertens.getExposureWeight())
+            local.mergeDebevec = cv2.createMergeDebevec()
+            local.calibrateDebevec = cv2.createCalibrateDebevec()
+            local.toneMap = cv2.createTonemapReinhard()
+            local.alignCoarse = cv2.createAlignMTB(4, 4, True)
+            local.alignFine = cv2.createAlignMTB(3, 4, True)
+        return local
+
+# Per stage processing times, smoothed over the last frames, shown by the GUI
+    def recordStage(self, name, seconds):
+        with self.stageLock:
+            previous = self.stageTimes.get(name)
+            self.stageTimes[name] = seconds if previous is None else previous * 0.9 + seconds * 0.1
+
+# Status polled by the GUI timer (the workers do not signal it): frames waiting for a worker
+    def statusText(self):
+        if self.pipeline is None:
+            return ''
+        return 'queue {0}/{1} lost {2}'.format(self.pipeline.queueDepth(), self.pipeline.queueSize,
+                                               self.assembler.evictedSets)
+
+    def stageText(self):
+        with self.stageLock:
+            return '\n'.join('{0} {1:.0f} ms'.format(name, seconds * 1000.)
+                             for name, seconds in sorted(self.stageTimes.items()))
+
+# Align the exposures on the middle one, returns new images for the shifted ones
+    def alignBracket(self, images):
+        mergers = self.mergers()
+        start = time.perf_counter()
+        shifts = bracketShifts(mergers.alignCoarse, mergers.alignFine, images, len(images) // 2, self.alignReduce)
+        shifted = time.perf_counter()
+        images = alignImages(images, shifts)
+        self.recordStage('align shift', shifted - start)
+        self.recordStage('align warp', time.perf_counter() - shifted)
+        return images
+
+# Collect the exposures of one frame, they may be decoded by different workers
+# Returns the BracketSet when complete, to be released once merged
+    def collectBracket(self, count, bracket, image, shutter):
+        slot = self.assembler.reserve(count, bracket, max(self.brackets, bracket), image.shape)
+        if slot is None:
+            return None
+        bracketSet, index = slot
+        if not self.assembler.write(bracketSet, index, image, shutter):
+            return None
+        return bracketSet
+
+# An incomplete bracket set was dropped (an exposure never came), called by the assembler
+    def bracketEvicted(self, count):
+        if self.saveOn:
+            frame = count + (self.startframe - 1)
+            self.headerSignal.emit({'type': HEADER_MESSAGE, 'msg': "Frame %d not saved: incomplete bracket set" % frame})
+
+# uint8 output of a merge, reused by the worker when the frame is only displayed (resized copy)
+# A saved or full size frame leaves the worker, it gets a new buffer
+    def mergeOutput(self, shape, factor):
+        if self.saveOn or factor == 1:
+            return None
+        local = self.mergeLocal
+        out = getattr(local, 'mergeOutput', None)
+        if out is None or out.shape != shape:
+            out = np.empty(shape, np.uint8)
+            local.mergeOutput = out
+        return out
+
+# Copy of the worker merge output if saving started during the merge
+    def ownedImage(self, image):
+        if image is getattr(self.mergeLocal, 'mergeOutput', None):
+            return image.copy()
+        return image
+
+# Merge a complete bracket set (bracket 3 2 1 order), returns the calibrated uint8 image
+# Normalize, calibration, scale and saturation are done in one pass (finishMerge)
+# local: merge in the calling thread even if there is a merge engine (small preview merges)
+# factor: reduce factor of the frame, 1 if the merged image is not resized for display
+    def mergeBracket(self, images, shutters, local=False, factor=1):
+        if self.alignBrackets and len(images) > 1:
+            images = self.alignBracket(images)
+        start = time.perf_counter()
+        shape = images[0].shape
+        table = self.calibrationTable(shape) if self.doCalibrate else None
+        out = self.mergeOutput(shape, factor)
+        tileSize = 0
+        if self.merge == MERGE_MERTENS and self.mergeMemoryBudget > 0:
+            tileSize = mertensTileSize(len(images), self.mergeMemoryBudget * 1000000)
+            if tileSize >= max(shape[:2]):
+                tileSize = 0  # Fits in the budget
+        response = None
+        if self.merge == MERGE_DEBEVEC:
+            times = np.asarray(shutters, dtype=np.float32)/1000000.
+            response = self.responseCurve()
+            if response is None:
+                self.estimateResponse(images, times)
+        if self.mergeEngine is not None and not local:
+            # Merged image is 0..1, converted from the shared memory
+            image = self.mergeEngine.merge(images, shutters, self.merge, response,
+                                           lambda merged: finishMerge(merged, table, out), tileSize)
+        elif self.merge == MERGE_MERTENS and tileSize > 0:
+            image = tiledMertens(self.mergers().mergeMertens, images, np.empty(shape, np.float32), tileSize)
+            image = finishMerge(image, table, out, normalize=True)
+        elif self.merge == MERGE_MERTENS:
+            image = self.mergers().mergeMertens.process(images)
+            image = finishMerge(image, table, out, normalize=True)
+        else:
+            mergers = self.mergers()
+            if response is not None:
+                image = mergers.mergeDebevec.process(images, times, response)
+            else:
+                image = mergers.mergeDebevec.process(images, times)
+            image = finishMerge(mergers.toneMap.process(image), table, out)
+        self.recordStage('preview merge' if local else 'merge', time.perf_counter() - start)
+        return image
+
+
+# Preview of a complete bracket set (previewMerge), calibrated uint8, ready to display
+# Merged in the frame worker at 1/max(reduceFactor, previewMergeReduce) of the full size,
+# or the longest usable exposure scaled down
+# reduced: the exposures were decoded at 1/reduceFactor
+    def previewMergeImage(self, bracketSet, reduced, reduceFactor):
+        images = bracketSet.images()
+        shutters = bracketSet.shutters
+        factor = float(max(reduceFactor, self.previewMergeReduce))
+        if reduced:
+            factor /= reduceFactor
+        if self.previewMerge == PREVIEW_MERGE_EXPOSURE:
+            images = [images[usableExposure(images, shutters)]]
+        if factor > 1:
+            height, width = images[0].shape[:2]
+            size = (max(1, int(width / factor)), max(1, int(height / factor)))
+            images = [cv2.resize(image, dsize=size, interpolation=cv2.INTER_AREA) for image in images]
+        if self.previewMerge != PREVIEW_MERGE_EXPOSURE:
+            return self.mergeBracket(images, shutters, local=True)
+        image = images[0]
+        table = self.calibrationTable(image.shape) if self.doCalibrate else None
+        if table is not None:
+            return applyCalibration(image, table, image if factor > 1 else None)
+        return image if factor > 1 else image.copy()  # Not a view of the bracket buffer
+
+# Full resolution merge of a saved bracket set, behind the preview
+# At most 2 x backgroundMerges sets wait or merge, then the frame workers block (back pressure)
+    def saveMergeInBackground(self, count, bracketSet):
+        self.currentframe = count + (self.startframe - 1)
+        path = self.directory + "/image_%#05d.jpg" % self.currentframe
+        self.saveMergeSlots.acquire()
+        try:
+            self.saveMerger.submit(self.saveMerge, path, bracketSet)
+        except Exception:
+            self.saveMergeSlots.release()
+            raise
+
+    def saveMerge(self, path, bracketSet):
+        try:
+            image = self.mergeBracket(bracketSet.images(), bracketSet.shutters)
+            self.writer.writeImage(path, self.ownedImage(image))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.assembler.release(bracketSet)
+            self.saveMergeSlots.release()
+
+# Decoded pixels are needed to merge or calibrate, a saved Jpeg is written from the received bytes
+    def needsPixels(self, bracket):
+        return (self.merge != MERGE_NONE and bracket != 0) or self.doCalibrate
+
+# Full resolution pixels are only needed to merge, calibrate or measure sharpness
+# With a preview merge, bracket sets that are not saved are decoded reduced too
+    def previewOnly(self, bracket, factor):
+        if factor not in REDUCED_DECODE:
+            return False
+        if self.merge != MERGE_NONE and bracket != 0:
+            return self.previewMerge != PREVIEW_MERGE_NONE and not self.saveOn
+        return not self.needsPixels(bracket) and not (self.sharpness and bracket == 0)
+
+# Decode scaled down by factor (2, 4 or 8, see previewOnly) in the Jpeg decoder (1/2, 1/4, 1/8 of the DCT)
+    def decodeReduced(self, jpeg, factor):
+        if self.turboJpeg is not None:
+            return self.turboJpeg.decode(jpeg, scaling_factor=(1, factor))
+        return cv2.imdecode(jpeg, REDUCED_DECODE[factor])
+
+# The received Jpeg is saved as is and nothing needs the decoded pixels
+    def isPassthrough(self):
+        return self.passthrough and self.saveOn and self.merge == MERGE_NONE and not self.doCalibrate
+
+# Passthrough frames decoded for display, histogram and sharpness
+    def samplePreview(self, count, bracket):
+        if not self.previewEnabled or bracket > 1:
+            return False  # Only the last exposure of a bracket
+        if self.passthroughInterval > 0:
+            with self.sampleLock:
+                now = time.time()
+                if now - self.lastSample < self.passthroughInterval:
+                    return False
+                self.lastSample = now
+                return True
+        return count % max(1, self.passthroughEvery) == 0
+
+# The writer keeps the leased receive buffer until the file is written
+    def saveJpeg(self, count, bracket, jpeg, lease):
+        self.currentframe = count + (self.startframe - 1)
+        if bracket != 0:
+            path = self.directory + "/image_%#05d_%#02d.jpg" % (self.currentframe, bracket)
+        else:
+            path = self.directory + "/image_%#05d.jpg" % self.currentframe
+        self.writer.writeBytes(path, jpeg, lease.acquire().release)
+
+# Called by the pipeline workers with a leased receive buffer, released once decoded
+# Returns (image, histos, (count, sharpness)) to be displayed or None
+    def processImage(self, header, lease):
+        try:
+            return self.processJpeg(header, np.frombuffer(lease.view, np.uint8), lease)
+        finally:
+            lease.release()
+
+    def processJpeg(self, header, jpeg, lease):
         bracket = header['bracket']
         count = header['count']
-        jpeg = np.frombuffer(jpeg, np.uint8, count=len(jpeg))
-        image = cv2.imdecode(jpeg, 1)   # Jpeg decoded
-        #update status
-        self.captureStatusInfo = "processing image"
-        self.statusSignal.emit()
+        factor = self.reduceFactor  # The same for the whole frame even if the GUI changes it
+        passthrough = self.isPassthrough()
+        if passthrough:
+            self.saveJpeg(count, bracket, jpeg, lease)
+            if not self.samplePreview(count, bracket):
+                return None
+        elif not self.previewEnabled and not self.needsPixels(bracket):
+            if self.saveOn:
+                self.saveJpeg(count, bracket, jpeg, lease)
+            return None
+        reduced = self.previewOnly(bracket, factor)
+        start = time.perf_counter()
+        if reduced:
+            image = self.decodeReduced(jpeg, factor)
+        else:
+            image = cv2.imdecode(jpeg, 1)   # Jpeg decoded
+        self.recordStage('decode', time.perf_counter() - start)
 
         isJpeg = True
+        saved = False
         if self.merge != MERGE_NONE and bracket != 0:  # Merge We receive bracket 3 2 1
             # image = cv2.LUT(image, self.gamma)
-            self.images.append(image)
-            self.shutters.append(header['shutter'])
-            if bracket != 1:
-                return
+            bracketSet = self.collectBracket(count, bracket, image, header['shutter'])
+            if bracketSet is None:
+                return None
+            elif self.previewMerge == PREVIEW_MERGE_NONE:
+                try:
+                    image = self.mergeBracket(bracketSet.images(), bracketSet.shutters, factor=factor)
+                finally:
+                    self.assembler.release(bracketSet)
             else:
-                if self.merge == MERGE_MERTENS:
-                    image = self.mergeMertens.process(self.images)
-                    image = cv2.normalize(image, None, 0., 1., cv2.NORM_MINMAX)
-                else:
-                    times = np.asarray(self.shutters, dtype=np.float32)/1000000.
-#                    responseDebevec = self.calibrateDebevec.process(self.images, times)
-#                    image = self.mergeDebevec.process(self.images, times, responseDebevec)
-                    image = self.mergeDebevec.process(self.images, times)
-                    image = self.toneMap.process(image)
-                if self.doCalibrate:
-                    image = image * self.table
-                image = np.clip(image*255, 0, 255).astype('uint8')
+                # Quick preview now, the saved frame is merged at full resolution in the background
+                image = None
+                try:
+                    if self.previewEnabled:
+                        image = self.previewMergeImage(bracketSet, reduced, factor)
+                    if self.saveOn and not reduced:
+                        self.saveMergeInBackground(count, bracketSet)  # Releases the set when merged
+                        saved = True
+                finally:
+                    if not saved:
+                        self.assembler.release(bracketSet)
+                saved = True  # A set decoded reduced (save started mid set) is not saved at preview size
+                reduced = True  # Already preview size
 #                image = cv2.LUT(image, self.invgamma)
 
 #                 if self.equalize :
@@ -168,127 +507,144 @@ class ImageThread (QThread):
 #                 if self.wb :
 #                     image = self.simpleWB.balanceWhite(image)
 #                     image = self.simplest_cb(image, 1)
-                isJpeg = False
-                self.images.clear()
-                self.shutters.clear()
-        elif self.doCalibrate:
-            image = image * self.table
-            image = np.clip(image, 0, 255).astype('uint8')
-            image = image.astype(np.uint8)
             isJpeg = False
+        elif self.doCalibrate:
+            table = self.calibrationTable(image.shape)
+            if table is not None:
+                image = applyCalibration(image, table, image)  # In place, the decoded image is ours
+                isJpeg = False
 
-        if self.saveOn:
-            self.currentframe = count + (self.startframe - 1)
-            if not os.path.exists(self.directory):
-                os.makedirs(self.directory)
+        if self.saveOn and not passthrough and not saved:
             if isJpeg:
-                if bracket != 0:
-                    file = open(self.directory + "/image_%#05d_%#02d.jpg" % (self.currentframe, bracket), 'wb')
-                else:
-                    file = open(self.directory + "/image_%#05d.jpg" % self.currentframe, 'wb')
-                file.write(jpeg)
-                file.close()
+                self.saveJpeg(count, bracket, jpeg, lease)
             else:
-                cv2.imwrite(self.directory + "/image_%#05d.jpg" % self.currentframe, image)
+                self.currentframe = count + (self.startframe - 1)
+                self.writer.writeImage(self.directory + "/image_%#05d.jpg" % self.currentframe, self.ownedImage(image))
                 
+        if not self.previewEnabled or image is None:
+            return None
+
+        sharpness = None
         if isJpeg and bracket == 0 and self.sharpness:
-            sharpness = cv2.Laplacian(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var()
-            cv2.putText(image, str(sharpness), (200, 200), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 2)
+            sharpness = sharpnessMetric(image, self.sharpnessRoi, self.sharpnessReduce)
         
+        histos = None
         if self.histos:
-            self.calcHistogram(image)
-        if self.reduceFactor != 1:
-            newShape = (int(image.shape[1]/self.reduceFactor), int(image.shape[0]/self.reduceFactor))
+            histos = self.calcHistogram(image)
+        if factor != 1 and not reduced:
+            newShape = (int(image.shape[1]/factor), int(image.shape[0]/factor))
             image = cv2.resize(image, dsize=newShape, interpolation=cv2.INTER_CUBIC)            
-        self.imageSignal.emit(image)  # «display image in the GUI
+        if self.sharpness and self.focusPeaking:
+            image = focusPeaking(image, self.focusPeakingThreshold)  # A copy, image may be queued to the writer
+        image = self.ownedImage(image)
 #         print(np.min(image, axis=(0,1)))
 #         print(np.max(image, axis=(0,1)))
 #         print(np.mean(image, axis=(0,1)))
 #         cv2.imshow("PiCamera", image)
 #         cv2.waitKey(1)
-        #update status
-        self.captureStatusInfo = "ready"
-        self.statusSignal.emit()
         time.sleep(0)  #yield other threads
+        return image, histos, (count, sharpness)
+
+# Called by the pipeline reorder stage, in count order
+# Replace the frame waiting for the GUI, signal only if the GUI has not been signaled yet
+# so Qt never queues more than one preview
+    def emitFrame(self, result):
+        count, sharpness = result[2]
+        if sharpness is not None:
+            self.sharpnessHistory.append((count, sharpness))
+        with self.previewLock:
+            if self.previewFrame is not None:
+                self.droppedPreviews += 1
+            self.previewFrame = result
+            if self.previewScheduled:
+                return
+            self.previewScheduled = True
+        self.previewSignal.emit()  # «display image in the GUI
+
+# Called by the GUI, returns the newest (image, histos, (count, sharpness)) or None
+    def takePreview(self):
+        with self.previewLock:
+            result = self.previewFrame
+            self.previewFrame = None
+            self.previewScheduled = False
+        return result
 
         # def lensAnalyze(self, header) :
     def lensAnalyze(self):
         image = self.imageSock.receiveArray()  # bgr
-        if self.doCalibrate:
-            image = image * self.table
-            image = image.astype(np.uint8)
-        x = image.shape[0]/image.shape[1]
-        valuesDiagonal = np.empty((image.shape[1], 3))
-        for i in range(image.shape[1]):  # 3280
-            j = int(i * x)
-            valuesDiagonal[i, :] = image[j, i, :]
-
-        colors = ('b', 'g', 'r')
-        figure = plt.figure(figsize=(10, 3))
-        axe = figure.add_subplot(1, 3, 1)
-        axe.title.set_text('Horizontal')
-        for i, col in enumerate(colors):
-            axe.plot(image[image.shape[0]//2, :, i], color=col)  # Horizontal
-        axe = figure.add_subplot(1, 3, 2)
-        axe.title.set_text('Vertical')
-        for i, col in enumerate(colors):
-            axe.plot(image[:, image.shape[1]//2, i], color=col)  # Vertical
-        axe = figure.add_subplot(1, 3, 3)
-        axe.title.set_text('Diagonal')
-        for i, col in enumerate(colors):
-            axe.plot(valuesDiagonal[:, i], color=col)  # Diagonal
-#        figure.subplots_adjust(top=0.85)
-        figure.tight_layout()
-        figure.canvas.draw()
-        plt.close()
-        canvasWidth, canvasHeight = figure.canvas.get_width_height()
-        image = np.fromstring(figure.canvas.tostring_rgb(), dtype=np.uint8).reshape(canvasHeight, canvasWidth, 3)
-        self.plotSignal.emit(image)  # «display plot in the GUI
-#        plt.show()
-
-# Normalize each channel toward the Min
+        table = self.calibrationTable(image.shape) if self.doCalibrate else None
+        if table is not None:
+            image = applyCalibration(image, table)
+        self.plotSignal.emit(lensProfiles(image))  # «display plot in the GUI
+        scores = focusMap(image, self.focusTiles[0], self.focusTiles[1])
+        self.focusSignal.emit(focusMapOverlay(image, scores))
+
+# Normalize each channel toward the mean
+# The count frames are accumulated (mean and variance, outliers rejected), the gains are computed on the last one
     def calibrate(self, header):
         image = self.imageSock.receiveArray()  # bgr
         i = header['num']
         count = header['count']
-        if i != 0:
-            image = image * self.table
-        gains = np.copy(image).astype(np.float)
-#        ih, iw, nc = image.shape
-#        centre = np.min(image, axis=(0, 1))
-        centre = np.mean(image, axis=(0, 1))
-
-#         print(np.min(image, axis=(0, 1)))
-#         print(np.max(image, axis=(0, 1)))
-#         print(np.mean(image, axis=(0, 1)))
-        gains = centre/gains
-        if i == 0:    # First one
-            self.table = gains
-        else:
-            self.table = self.table*gains
-#         print(np.min(self.table, axis=(0, 1)))
-#         print(np.max(self.table, axis=(0, 1)))
-#        self.table[self.table>1.] = 1.
+        if i == 0 or self.flatField is None:
+            self.flatField = FlatFieldAccumulator(image.shape, rejectSigma=self.calibrationRejectSigma,
+                                                  minFrames=self.calibrationMinFrames)
+        if not self.flatField.add(image):
+            header = {'type': HEADER_MESSAGE, 'msg': "Local Calibration frame %d rejected" % i}
+            self.headerSignal.emit(header)
         if i == count - 1:
-            np.savez('calibrate.npz', table=self.table)
-        header = {'type': HEADER_MESSAGE, 'msg': "Local Calibration done"}
-        self.headerSignal.emit(header)  # «display header info in GUI if necessary (count,...)
+            flatField, self.flatField = self.flatField, None
+            try:
+                table = flatField.gains()
+            except ValueError as error:  # All rejected: the previous table is kept
+                self.headerSignal.emit({'type': HEADER_MESSAGE, 'msg': "Local Calibration failed: %s" % error})
+                return
+            try:
+                saveCalibrationTable('calibrate.npy', table)
+            except OSError as error:
+                self.headerSignal.emit({'type': HEADER_MESSAGE, 'msg': "Calibration table not saved: %s" % error})
+            with self.calibrationLock:
+                self.table = table
+                self.calibrationTables = {}
+            header = {'type': HEADER_MESSAGE, 'msg': "Local Calibration done (%d/%d frames)" % (flatField.frames, count)}
+            self.headerSignal.emit(header)  # «display header info in GUI if necessary (count,...)
             
     def saveToFile(self, saveFlag, directory, startframe):
         self.saveOn = saveFlag
         self.directory = directory
         self.startframe = startframe
+        self.assembler.clear()  # A new capture, drop the incomplete bracket sets
+        if self.writer is not None:
+            self.writer.newClip()
 
     def run(self):
         print('ImageThread started')
         self.imageSock = None
+        self.mergeEngine = None
+        if self.mergeProcesses > 0:
+            self.mergeEngine = MergeEngine(self.mergeProcesses)
+            self.mergeEngine.start()  # Spawned before the first frame, not by a frame worker
+        self.writer = FrameWriter(self.writerQueueSize, self.writerEncoders, self.fsyncPolicy)
+        self.writer.start()
+        self.saveMerger = ThreadPoolExecutor(max_workers=max(1, self.backgroundMerges), thread_name_prefix='SaveMerge')
+        saveMergeSlots = max(1, 2 * self.backgroundMerges)
+        self.saveMergeSlots = threading.Semaphore(saveMergeSlots)
+        # A frame worker waits for its merge, so keep enough workers to feed all the merge processes
+        self.pipeline = FramePipeline(self.processImage, self.emitFrame,
+                                      max(self.workers, self.mergeProcesses), self.queueSize)
+        # Each worker writes or merges one set, each background merge holds one, plus the set still
+        # being received: with fewer buffers the workers wait for one (allocated when first needed)
+        self.assembler.maxSets = self.pipeline.workers + saveMergeSlots + self.bracketSetMargin
+        self.pipeline.start()
+        # Enough free buffers for the frames queued for the workers and the writer
+        self.bufferPool = BufferPool(self.queueSize + self.pipeline.workers + self.writerQueueSize)
         try:
             sock = socket.socket()
             sock.connect((self.ip_pi, 8000))
             print('ImageThread connected')
             self.imageSock = MessageSocket(sock)
+            self.imageSock.offerHeaderProtocol()  # Binary headers if the Pi knows them
             while True:
-                header = self.imageSock.receiveObject()
+                header = self.imageSock.receiveHeader()
                 # if header == None :
                 if header is None:
                     print('Closed connection')
@@ -302,8 +658,11 @@ class ImageThread (QThread):
                     break
                 self.headerSignal.emit(header)  # «display header info in GUI if necessary (count,...)
                 if typ == HEADER_IMAGE:
-                    image = self.imageSock.receiveMsg()
-                    self.processImage(header, image)
+                    lease = self.imageSock.receiveMsgLeased(self.bufferPool)  # No allocation per frame
+                    if lease is None:
+                        print('Closed connection')
+                        break
+                    self.pipeline.submit(header, lease)  # Blocks when the workers are behind
                 elif typ == HEADER_BGR:
                     self.processBgr()
                 elif typ == HEADER_CALIBRATE:
@@ -316,6 +675,11 @@ class ImageThread (QThread):
 #                    self.processHdrImage(header, image)
                 
         finally:
+            self.pipeline.stop()
+            self.saveMerger.shutdown(wait=True)  # Saved merges still go to the writer
+            self.writer.stop()
+            if self.mergeEngine is not None:
+                self.mergeEngine.shutdown()
             print('ImageThread terminated')
             cv2.destroyAllWindows()
             # if self.imageSock != None:
@@ -0,0 +1,164 @@
+import sys
+import threading
+import multiprocessing
+import numpy as np
+import cv2
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append('../Common')
+from Constants import *
+from ImageProcessing import tiledMertens
+
+# HDR merge engine
+# A bracket set (the exposures and their shutters) is copied into a shared memory slot
+# and merged by a process pool, so several sets are merged at once on several cores
+# without pickling the images and without holding the GIL of the GUI process.
+# The merged image (float32, 0..1) comes back through a second shared memory block.
+# merge() blocks the calling frame worker until its set is done, the frame order is
+# kept by the FramePipeline reorder stage.
+# A finish function can convert the merged image straight from the shared memory
+# (eg. to calibrated uint8), without a float32 copy.
+# One slot per process: slots are reused while the resolution does not change.
+# The Debevec camera response (a small 256x1x3 array) is passed with the set when known.
+# With a tile size, Mertens merges tile by tile (tiledMertens) so each process needs much
+# less memory and more processes fit on the machine.
+# The processes are spawned, not forked: the GUI process runs threads (Qt, OpenCV, sockets,
+# frame workers) and a forked child could inherit a lock held by one of them and deadlock.
+# start() is called by the image thread before the first frame: spawning the processes and
+# importing cv2 in them takes a while, it is not done by the worker of the first merge.
+
+
+# Worker process side
+processMergers = None
+
+
+def getProcessMergers():
+    global processMergers
+    if processMergers is None:
+        processMergers = (cv2.createMergeMertens(1, 1, 1),
+                          cv2.createMergeDebevec(),
+                          cv2.createTonemapReinhard())
+    return processMergers
+
+
+# Run once per process by MergeEngine.start
+def warmUp():
+    getProcessMergers()
+
+
+def mergeBracketSet(inName, outName, shape, count, shutters, merge, response=None, tileSize=0):
+    mergeMertens, mergeDebevec, toneMap = getProcessMergers()
+    inShm = shared_memory.SharedMemory(name=inName)
+    outShm = shared_memory.SharedMemory(name=outName)
+    try:
+        images = np.ndarray((count,) + shape, np.uint8, buffer=inShm.buf)
+        out = np.ndarray(shape, np.float32, buffer=outShm.buf)
+        exposures = [images[i] for i in range(count)]
+        if merge == MERGE_MERTENS and tileSize > 0:
+            tiledMertens(mergeMertens, exposures, out, tileSize)
+            cv2.normalize(out, out, 0., 1., cv2.NORM_MINMAX)
+        elif merge == MERGE_MERTENS:
+            image = mergeMertens.process(exposures)
+            cv2.normalize(image, out, 0., 1., cv2.NORM_MINMAX)
+        else:
+            times = np.asarray(shutters, dtype=np.float32)/1000000.
+            if response is not None:
+                image = mergeDebevec.process(exposures, times, response)
+            else:
+                image = mergeDebevec.process(exposures, times)
+            out[...] = toneMap.process(image)
+        # Views must be released before closing the shared memory
+        del exposures, images, out
+    finally:
+        inShm.close()
+        outShm.close()
+
+
+# GUI process side
+class MergeEngine:
+
+    def __init__(self, processes):
+        self.processes = max(1, processes)
+        self.executor = None
+        self.condition = threading.Condition()
+        self.freeSlots = []
+        self.slotCount = 0
+
+    def start(self):
+        with self.condition:
+            if self.executor is not None:
+                return
+            self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                mp_context=multiprocessing.get_context('spawn'))
+            # Start the processes and their mergers now
+            warmups = [self.executor.submit(warmUp) for i in range(self.processes)]
+        for warmup in warmups:
+            warmup.result()
+
+    def shutdown(self):
+        with self.condition:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self.condition:
+            for slot in self.freeSlots:
+                self.unlinkSlot(slot)
+            self.slotCount -= len(self.freeSlots)
+            self.freeSlots = []
+
+    def unlinkSlot(self, slot):
+        for shm in slot:
+            shm.close()
+            shm.unlink()
+
+# Wait for a free slot large enough, reallocate it if the resolution grew
+    def acquireSlot(self, inBytes, outBytes):
+        with self.condition:
+            while not self.freeSlots and self.slotCount >= self.processes:
+                self.condition.wait()
+            if self.freeSlots:
+                slot = self.freeSlots.pop()
+                if slot[0].size >= inBytes and slot[1].size >= outBytes:
+                    return slot
+                self.unlinkSlot(slot)
+            else:
+                self.slotCount += 1
+        try:
+            return (shared_memory.SharedMemory(create=True, size=inBytes),
+                    shared_memory.SharedMemory(create=True, size=outBytes))
+        except (Exception, BaseException):
+            with self.condition:
+                self.slotCount -= 1
+                self.condition.notify()
+            raise
+
+    def releaseSlot(self, slot):
+        with self.condition:
+            self.freeSlots.append(slot)
+            self.condition.notify()
+
+# Merge a bracket set, called from the frame workers
+# Returns finish(merged) or a copy of the merged float32 image 0..1
+    def merge(self, images, shutters, merge, response=None, finish=None, tileSize=0):
+        self.start()  # Already started by the image thread
+        shape = images[0].shape
+        count = len(images)
+        frameBytes = int(np.prod(shape))
+        slot = self.acquireSlot(count * frameBytes, frameBytes * 4)
+        try:
+            inShm, outShm = slot
+            exposures = np.ndarray((count,) + shape, np.uint8, buffer=inShm.buf)
+            for i, image in enumerate(images):
+                exposures[i] = image
+            del exposures
+            future = self.executor.submit(mergeBracketSet, inShm.name, outShm.name,
+                                          shape, count, list(shutters), merge, response, tileSize)
+            future.result()
+            out = np.ndarray(shape, np.float32, buffer=outShm.buf)
+            image = finish(out) if finish is not None else out.copy()
+            del out
+        finally:
+            self.releaseSlot(slot)
+        return image
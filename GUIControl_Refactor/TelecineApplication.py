@@ -7,20 +7,16 @@ import numpy as np
 from fractions import Fraction
 import os
 
-# import matplotlib with agg backend
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-
 # from PyQt5.QtWidgets import QDialog, QApplication, QSpinBox, QFileDialog
-from PyQt5.QtWidgets import QDialog, QApplication, QFileDialog
+from PyQt5.QtWidgets import QDialog, QApplication, QFileDialog, QWidget, QCheckBox, QVBoxLayout, QLabel
 # from PyQt5.QtGui import QImage, QPainter,QPixmap
-from PyQt5.QtGui import QImage, QPainter
+from PyQt5.QtGui import QImage, QPainter, QPixmap, QColor, QPen, QPolygonF
 # from PyQt5.QtCore import QObject, pyqtSignal, QTimer, Qt
-from PyQt5.QtCore import QTimer, Qt
+from PyQt5.QtCore import QTimer, Qt, QEvent, QPointF, QRect, pyqtSignal
 
 from TelecineDialogUI import Ui_TelecineDialog
 from ImageThread import ImageThread
+from CommandClient import CommandClient
 
 sys.path.append('../Common')
 from Constants import *
@@ -44,7 +40,30 @@ localSettings = (
     'doCalibrateLocalState',
     'redGain',
     'blueGain',
-    'doSaveToFile')
+    'doSaveToFile',
+    'processingWorkers',
+    'processingQueueSize',
+    'mergeProcesses',
+    'commandTimeout',
+    'settingsInterval',
+    'mergeMemoryBudget',
+    'alignBrackets',
+    'previewMerge',
+    'previewMergeReduce',
+    'backgroundMerges',
+    'writerQueueSize',
+    'fsyncPolicy',
+    'passthrough',
+    'passthroughEvery',
+    'passthroughInterval',
+    'maxPreviewFps',
+    'histogramLogScale',
+    'histogramSamples',
+    'calibrationFrames',
+    'focusTiles',
+    'sharpnessRoi',
+    'sharpnessReduce',
+    'focusPeaking')
 
 
 # Generic method to set/get object attributes from a dictionary
@@ -63,6 +82,7 @@ def setSettings(classObject, settings):
 
 
 class TelecineDialog(QDialog, Ui_TelecineDialog):
+    replySignal = pyqtSignal(object, object)  # Command reply: callback, future
 
     def __init__(self):
         super(TelecineDialog, self).__init__()
@@ -70,6 +90,11 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         #
         self.applicationVersion = 0.82
         self.sock = None
+        self.commands = None  # CommandClient, the command socket I/O runs in its threads
+        self.commandTimeout = 5.  # Seconds without a reply before the pending requests fail and the channel resyncs
+        self.settingsInterval = 0.1  # Camera settings changes are merged and sent at most every interval
+        self.replySignal.connect(self.deliverReply)
+        QApplication.instance().focusChanged.connect(self.flushSettings)  # Focus out sends the pending settings
         self.connected = False
         self.cameraIsOpen = False
         self.motorIsOn = False
@@ -114,10 +139,38 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         self.doCalibrateLocalState = False
         self.imageDialog = None
         self.plotDialog = None
+        self.histogramDialog = None
+        self.histogramLogScale = False
+        self.histogramSamples = 250000  # Pixels sampled for the histograms, 0 for all
+        self.calibrationFrames = 8  # Frames averaged for the local calibration
+        self.focusTiles = (6, 8)  # Lens analysis focus map grid (rows, cols)
+        self.sharpnessRoi = 0.5  # Live sharpness: centre fraction of the frame
+        self.sharpnessReduce = 1  # Live sharpness: roi reduction
+        self.focusPeaking = False  # Paint the sharp edges of the preview when sharpness is on
+        self.sharpnessDialog = None
+        self.lastSharpnessCount = None
         self.whiteBalanceButton.setEnabled(False)
         self.maxFpsButton.setEnabled(False)
         self.redGain = 100
         self.blueGain = 100
+        self.processingWorkers = 4  # ImageThread frame workers
+        self.processingQueueSize = 8  # Received frames waiting for a worker
+        self.mergeProcesses = max(1, (os.cpu_count() or 2) // 2)  # HDR merge processes, 0 merges in the workers
+        self.alignBrackets = False  # Align the exposures of a bracket set before merging (film weave)
+        self.mergeMemoryBudget = 0  # MB per Mertens merge, tiled above, 0 for whole frame merges
+        self.previewMerge = PREVIEW_MERGE_NONE  # Bracket preview: full merge, reduced merge or best exposure
+        self.previewMergeReduce = 4  # Reduced preview merge size 1/previewMergeReduce at least
+        self.backgroundMerges = 2  # Full resolution merges of the saved frames behind the preview
+        self.writerQueueSize = 32  # Frames waiting to be written to disk
+        self.fsyncPolicy = FSYNC_NONE
+        self.passthrough = False  # Save straight Jpeg captures without decoding, display a sample
+        self.passthroughEvery = 10
+        self.passthroughInterval = 0.
+        self.maxPreviewFps = 25.  # Preview refresh limit, newer frames replace the waiting one
+        self.lastPreviewTime = 0.
+        self.statusTimer = QTimer()  # Image thread status, polled while connected
+        self.statusTimer.timeout.connect(self.showImageThreadStatus)
+        self.statusInterval = 250  # ms
 
 
 # Lamp
@@ -174,7 +227,7 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
             self.updateGuiState()
 
     def motorOn(self):
-        self.sock.sendObject((MOTOR_ON,))
+        self.commands.send((MOTOR_ON,))
         self.motorOnButton.setText('Turn off')
         self.motorOnButton.setStyleSheet("background-color: #00b95a")
         self.motorCalibrateButton.setEnabled(True)
@@ -183,7 +236,7 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
     def motorOff(self):
         self.motorOnButton.setText('Turn on')
         self.motorOnButton.setStyleSheet("background-color: #e3e3e3")
-        self.sock.sendObject((MOTOR_OFF,))
+        self.commands.send((MOTOR_OFF,))
         self.motorControlGroupBox.setEnabled(False)
         self.motorSettingsGroupBox.setEnabled(True)
         self.motorCalibrateButton.setEnabled(False)
@@ -191,15 +244,15 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
 
     def forwardOne(self):
         self.setMotorSettings({'speed': self.motorSpeedBox.value()})
-        self.sock.sendObject((MOTOR_ADVANCE_ONE, MOTOR_FORWARD))
+        self.commands.send((MOTOR_ADVANCE_ONE, MOTOR_FORWARD))
 
     def backwardOne(self):
         self.setMotorSettings({'speed': self.motorSpeedBox.value()})
-        self.sock.sendObject((MOTOR_ADVANCE_ONE, MOTOR_BACKWARD))
+        self.commands.send((MOTOR_ADVANCE_ONE, MOTOR_BACKWARD))
 
     def forward(self):
         self.setMotorSettings({'speed': self.motorSpeedBox.value()})
-        self.sock.sendObject((MOTOR_ADVANCE, MOTOR_FORWARD))
+        self.commands.send((MOTOR_ADVANCE, MOTOR_FORWARD))
         self.motorStopButton.setEnabled(True)
         self.forwardOneButton.setEnabled(False)
         self.backwardOneButton.setEnabled(False)
@@ -209,7 +262,7 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
 
     def backward(self):
         self.setMotorSettings({'speed': self.motorSpeedBox.value()})
-        self.sock.sendObject((MOTOR_ADVANCE, MOTOR_BACKWARD))
+        self.commands.send((MOTOR_ADVANCE, MOTOR_BACKWARD))
         self.motorStopButton.setEnabled(True)
         self.forwardOneButton.setEnabled(False)
         self.backwardOneButton.setEnabled(False)
@@ -218,7 +271,7 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         self.motorOnTriggerButton.setEnabled(False)
 
     def motorStop(self):
-        self.sock.sendObject((MOTOR_STOP,))
+        self.commands.send((MOTOR_STOP,))
         self.motorStopButton.setEnabled(False)
         self.forwardOneButton.setEnabled(True)
         self.backwardOneButton.setEnabled(True)
@@ -228,17 +281,17 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
 
     def motorOnTrigger(self):
         self.setMotorSettings({'speed': self.motorSpeedBox.value()})
-        self.sock.sendObject((MOTOR_ON_TRIGGER,))
+        self.commands.send((MOTOR_ON_TRIGGER,))
 
     def motorCalibrate(self):
         self.setMotorSettings({'speed': self.motorSpeedBox.value()})
-        self.sock.sendObject((CALIBRATE_MOTOR,))
+        self.commands.send((CALIBRATE_MOTOR,))
 
     def setMotorSettings(self, settings):
-        self.sock.sendObject((SET_MOTOR_SETTINGS, settings))
+        self.commands.send((SET_MOTOR_SETTINGS, settings))
         
     def setMotorInitSettings(self):
-        self.sock.sendObject((SET_MOTOR_SETTINGS, {
+        self.commands.send((SET_MOTOR_SETTINGS, {
             'steps_per_rev': self.stepsPerRevBox.value(),
             'pulley_ratio': self.pulleyRatioBox.value(),
             'ena_pin': int(self.enaEdit.text()),
@@ -253,8 +306,9 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
 
 # Get and display motor settings
     def getMotorSettings(self):
-        self.sock.sendObject((GET_MOTOR_SETTINGS,))
-        settings = self.sock.receiveObject()
+        return self.request((GET_MOTOR_SETTINGS,), self.showMotorSettings)
+
+    def showMotorSettings(self, settings):
         # print(settings)
         self.stepsPerRevBox.setValue(settings['steps_per_rev'])
         self.pulleyRatioBox.setValue(settings['pulley_ratio'])
@@ -309,9 +363,22 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
             calibrationMode = CALIBRATION_FLAT
         elif self.calibrateTableButton.isChecked():
             calibrationMode = CALIBRATION_TABLE
-        self.sock.sendObject((OPEN_CAMERA, self.mode, requestedResolution,
-                             calibrationMode, self.hflip, self.vflip))
-        maxResolution = self.getCameraSetting('MAX_RESOLUTION')
+        self.commands.send((OPEN_CAMERA, self.mode, requestedResolution,
+                           calibrationMode, self.hflip, self.vflip))
+        self.getCameraSetting('MAX_RESOLUTION', lambda maxResolution: self.cameraOpened(maxResolution, hres, vres))
+        self.lensAnalyseButton.setEnabled(True)
+        self.calibrateLocalButton.setEnabled(True)
+        self.whiteBalanceButton.setEnabled(True)
+        self.maxFpsButton.setEnabled(True)
+        self.setSharpness()
+        self.setHistos()
+        self.calibrateButton.setEnabled(False)
+        self.cameraIsOpen = True
+        self.openCameraButton.setText('Close camera')
+        self.openCameraButton.setStyleSheet("background-color: #00b95a")
+
+# The camera is open: set its resolution, then get the settings
+    def cameraOpened(self, maxResolution, hres, vres):
         if maxResolution[0] == 4056:
             self.cameraVersion = 3  # HQ
         elif maxResolution[0] == 3280:
@@ -325,25 +392,19 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
                 res = V1_RESOLUTIONS[self.mode-1]
             else:
                 res = V3_RESOLUTIONS[self.mode-1]
-            self.sock.sendObject((SET_CAMERA_SETTINGS, {'resolution': res}))
+            self.commands.setSettings({'resolution': res})
         self.cameraVersionLabel.setText('Picamera V' + str(self.cameraVersion))
-        self.resolution = self.getCameraSetting('resolution')
+        self.imageThread.setCamera(self.cameraVersion, self.mode)
+        self.getCameraSetting('resolution', self.showResolution)
+
+    def showResolution(self, resolution):
+        self.resolution = resolution
         self.hresLineEdit.setText(str(self.resolution[0]))
         self.vresLineEdit.setText(str(self.resolution[1]))
-        self.calibrateButton.setEnabled(False)
         self.getCameraSettings()
-        self.lensAnalyseButton.setEnabled(True)
-        self.calibrateLocalButton.setEnabled(True)
-        self.whiteBalanceButton.setEnabled(True)
-        self.maxFpsButton.setEnabled(True)
-        self.setSharpness()
-        self.setHistos()
-        self.cameraIsOpen = True
-        self.openCameraButton.setText('Close camera')
-        self.openCameraButton.setStyleSheet("background-color: #00b95a")
 
     def closeCamera(self):
-        self.sock.sendObject((CLOSE_CAMERA,))
+        self.commands.send((CLOSE_CAMERA,))
 #        self.cameraControlGroupBox.setEnabled(False)
 #        self.frameProcessingGroupBox.setEnabled(False)
 #        self.cameraSettingsGroupBox.setEnabled(False)
@@ -362,7 +423,7 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
     def calibrate(self):
         self.displayMessage("Calibrating please wait")
         QApplication.setOverrideCursor(Qt.WaitCursor)
-        self.sock.sendObject((CALIBRATE_CAMERA, self.hflipCheckBox.isChecked(), self.vflipCheckBox.isChecked()))
+        self.commands.send((CALIBRATE_CAMERA, self.hflipCheckBox.isChecked(), self.vflipCheckBox.isChecked()))
         # done = self.sock.receiveObject()
         QApplication.restoreOverrideCursor()
         self.displayMessage("done")
@@ -371,15 +432,16 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
     def calibrateLocal(self):
         self.displayMessage("Calibrating local please wait")
         self.setResize()
-        self.sock.sendObject((TAKE_BGR, HEADER_CALIBRATE, 1))  # Calibrate on 1 image
+        self.commands.send((TAKE_BGR, HEADER_CALIBRATE, self.calibrationFrames))  # Calibrate on n images
 
     def doCalibrateLocal(self):
         self.doCalibrateLocalState = self.calibrateLocalCheckBox.isChecked()
         self.imageThread.doCalibrate = self.calibrateLocalCheckBox.isChecked()
         
     def setWhiteBalance(self):
-        self.sock.sendObject((WHITE_BALANCE,))
-        gains = self.sock.receiveObject()
+        self.request((WHITE_BALANCE,), self.showWhiteBalance)
+
+    def showWhiteBalance(self, gains):
         self.redGainBox.setValue(int(float(gains[0])*100.))
         self.redGain = int(float(gains[0])*100.)
         self.blueGainBox.setValue(int(float(gains[1])*100.))
@@ -431,7 +493,7 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
                self.ROIyBox.value()/self.resolution[1],
                self.ROIwBox.value()/self.resolution[0],
                self.ROIhBox.value()/self.resolution[1])
-        self.sock.sendObject((SET_CAMERA_SETTINGS, {'zoom': roi}))
+        self.commands.setSettings({'zoom': roi})
 
     def resetROI(self):
         self.keepRatioCheckBox.setChecked(False)
@@ -446,9 +508,9 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         doResize = self.resizeCheckBox.isChecked()
         if doResize:
             resizeTo = (int(self.resizewBox.value()), int(self.resizehBox.value()))
-            self.sock.sendObject((SET_CAMERA_SETTINGS, {'doResize': doResize, 'resize': resizeTo}))
+            self.commands.setSettings({'doResize': doResize, 'resize': resizeTo})
         else:
-            self.sock.sendObject((SET_CAMERA_SETTINGS, {'doResize': doResize}))
+            self.commands.setSettings({'doResize': doResize})
         
 # Capture
 # CAPTURE_BASIC play with ot without motor
@@ -472,8 +534,9 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         if method != CAPTURE_BASIC:
             self.motorControlGroupBox.setEnabled(False)
             self.cameraControlGroupBox.setEnabled(False)
-            self.sock.sendObject((SET_MOTOR_SETTINGS, {'speed': self.captureMotorSpeedBox.value()}))
+            self.commands.send((SET_MOTOR_SETTINGS, {'speed': self.captureMotorSpeedBox.value()}))
 
+        self.reopenPreview()
         self.setMerge()  # Merge options
         self.setSave()  # Save options
         print('capture start')
@@ -489,7 +552,7 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         self.lensAnalyseButton.setEnabled(False)
         self.calibrateLocalButton.setEnabled(False)
         self.setResize()
-        self.sock.sendObject((SET_CAMERA_SETTINGS, {
+        self.commands.setSettings({
             'framerate': frameRate,
             'bracket_steps': brackets,
             'bracket_dark_coefficient': self.darkCoefficientBox.value(),
@@ -501,8 +564,8 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
             'capture_method': method,
             'pause_pin': int(self.pauseEdit.text()),
             'pause_level': 1 if self.pauseLevelCheckBox.isChecked() else 0
-        }))
-        self.sock.sendObject((START_CAPTURE,))
+        })
+        self.commands.send((START_CAPTURE,))
 
     def setMerge(self):
         # merge = None
@@ -532,11 +595,11 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         self.calibrateLocalButton.setEnabled(True)
 
         self.initGroupBox.setEnabled(True)
-        self.sock.sendObject((STOP_CAPTURE,))
+        self.commands.send((STOP_CAPTURE,))
         
 # Pausing capture
     def capturePause(self):
-        self.sock.sendObject((PAUSE_CAPTURE,))
+        self.commands.send((PAUSE_CAPTURE,))
         if self.paused:
             self.capturePauseButton.setText('Pause')
             self.captureStopButton.setEnabled(True)
@@ -546,26 +609,27 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         self.paused = not self.paused
 
     def setAutoPause(self):
-        self.sock.sendObject((SET_CAMERA_SETTINGS, {'auto_pause': self.autoPauseCheckBox.isChecked()}))
+        self.commands.setSettings({'auto_pause': self.autoPauseCheckBox.isChecked()})
 
 # Take one image
     def takeImage(self):
+        self.reopenPreview()
         self.setReduce()
         self.setResize()
         self.setSave()
-        self.sock.sendObject((SET_CAMERA_SETTINGS, {'use_video_port': True}))
-        self.sock.sendObject((TAKE_IMAGE,))
+        self.commands.setSettings({'use_video_port': True})
+        self.commands.send((TAKE_IMAGE,))
 
 # Get all camera settings
     def getCameraSettings(self):
         # hack: call GET_CAMERA_SETTNGS twice to trigger correct red/blue gain settings (hack to fix latency without refactoring raspberry controller)
-        self.sock.sendObject((GET_CAMERA_SETTINGS,))
-        settings = self.sock.receiveObject()
-        # print(settings)
-        self.sock.sendObject((GET_CAMERA_SETTINGS,))
-        settings = self.sock.receiveObject()
+        # The three requests are in flight together, the first reply is not used
+        self.request((GET_CAMERA_SETTINGS,), None)
+        self.request((GET_CAMERA_SETTINGS,), self.showCameraSettings)
+        return self.getCameraSetting('exposure_speed', lambda exposureSpeed: self.exposureSpeedLabel.setText(str(exposureSpeed)))
+
+    def showCameraSettings(self, settings):
         # print(settings)
-        print()
         self.redGainBox.setValue(int(float(settings['awb_gains'][0])*100.))
         self.redGain = int(float(settings['awb_gains'][0])*100.)
         self.blueGainBox.setValue(int(float(settings['awb_gains'][1])*100.))
@@ -575,8 +639,6 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         self.shutterSpeedBox.setValue(shutterSpeed)
         self.autoExposureCheckBox.setChecked(shutterSpeed == 0)
         self.framerateBox.setValue(int(settings['framerate']))
-        exposureSpeed = self.getCameraSetting('exposure_speed')
-        self.exposureSpeedLabel.setText(str(exposureSpeed))
         self.analogGainLabel.setText(str(float(settings['analog_gain'])))
         self.digitalGainLabel.setText(str(float(settings['digital_gain'])))
         self.redblueGainLabel.setText(
@@ -614,21 +676,39 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         
         resizeTo = settings['resize']
 #        if resize == None:
-        if resize is None:
+        if resizeTo is None:
             resizeTo = self.resolution
         self.resizewBox.setValue(resizeTo[0])
         self.resizehBox.setValue(resizeTo[1])
         
         self.resizeCheckBox.setChecked(settings['doResize'])
-        return settings
 
-# Get one camera setting
-    def getCameraSetting(self, myKey):
-        self.sock.sendObject((GET_CAMERA_SETTING, myKey))
-        return self.sock.receiveObject()
+# Get one camera setting, callback(value) in the GUI thread
+    def getCameraSetting(self, myKey, callback):
+        return self.request((GET_CAMERA_SETTING, myKey), callback)
+
+# Send a request, callback(reply) is called in the GUI thread when the reply comes
+# The GUI thread never waits: the reply comes through the command client future and replySignal
+    def request(self, command, callback):
+        future = self.commands.request(command)
+        if callback is not None:
+            future.add_done_callback(lambda done: self.replySignal.emit(callback, done))
+        return future
+
+    def deliverReply(self, callback, future):
+        try:
+            reply = future.result()
+        except Exception as error:  # Timeout or connection closed
+            self.displayMessage('No reply: {0}'.format(error))
+            return
+        callback(reply)
+
+    def flushSettings(self, old=None, new=None):
+        if self.commands is not None:
+            self.commands.flushSettings()
         
     def saveSettings(self):
-        self.sock.sendObject((SAVE_SETTINGS,))
+        self.commands.send((SAVE_SETTINGS,))
 
 # PSI: bundled function for all persistent values
     def setPersistentCameraValues(self):
@@ -647,19 +727,19 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         gains = (self.redGain/100., self.blueGain/100.)
         mode = str(self.awbModeBox.currentText())
         settings = {'awb_gains': gains, 'awb_mode': mode}
-        self.sock.sendObject((SET_CAMERA_SETTINGS, settings))
+        self.commands.setSettings(settings)
 
     def setShutterSpeed(self):
-        self.sock.sendObject((SET_CAMERA_SETTINGS, {'shutter_speed': self.shutterSpeedBox.value()}))
+        self.commands.setSettings({'shutter_speed': self.shutterSpeedBox.value()})
 
     def setExposureCompensation(self):
-        self.sock.sendObject((SET_CAMERA_SETTINGS, {'exposure_compensation': self.exposureCompensationBox.value()}))
+        self.commands.setSettings({'exposure_compensation': self.exposureCompensationBox.value()})
                  
     def setIso(self):
-        self.sock.sendObject((SET_CAMERA_SETTINGS, {'iso': self.isoBox.value()}))
+        self.commands.setSettings({'iso': self.isoBox.value()})
 
     def setFrameRate(self):
-        self.sock.sendObject((SET_CAMERA_SETTINGS, {'framerate': self.framerateBox.value()}))
+        self.commands.setSettings({'framerate': self.framerateBox.value()})
         
     def setSharpness(self):
         self.imageThread.sharpness = self.sharpnessCheckBox.isChecked()
@@ -670,17 +750,19 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         self.displayHistograms = self.histosCheckBox.isChecked()
 
     def setReduce(self):
-        self.imageThread.reduceFactor = self.reduceFactorBox.value()
+        self.imageThread.setReduceFactor(self.reduceFactorBox.value())
         
     def setAutoExposure(self):
         if self.autoExposureCheckBox.isChecked():
-            self.sock.sendObject((SET_CAMERA_SETTINGS, {'shutter_speed': 0}))
+            self.commands.setSettings({'shutter_speed': 0})
             self.shutterSpeedBox.setValue(0)
         else:
-            exposureSpeed = self.getCameraSetting('exposure_speed')
-            self.exposureSpeedLabel.setText(str(exposureSpeed))  # ms display
-            self.sock.sendObject((SET_CAMERA_SETTINGS, {'shutter_speed': exposureSpeed}))
-            self.shutterSpeedBox.setValue(exposureSpeed)
+            self.getCameraSetting('exposure_speed', self.setManualExposure)
+
+    def setManualExposure(self, exposureSpeed):
+        self.exposureSpeedLabel.setText(str(exposureSpeed))  # ms display
+        self.commands.setSettings({'shutter_speed': exposureSpeed})
+        self.shutterSpeedBox.setValue(exposureSpeed)
             
     def setAutoGetSettings(self):
         if self.autoGetSettingsCheckBox.isChecked():
@@ -691,24 +773,24 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
             self.timer.stop()
             
     def setCorrections(self):
-        self.sock.sendObject((SET_CAMERA_SETTINGS, {
+        self.commands.setSettings({
             'brightness': self.brightnessBox.value(),
             'contrast': self.contrastBox.value(),
-            'saturation': self.saturationBox.value()}))
+            'saturation': self.saturationBox.value()})
 
     def setGains(self):
         exposure_mode = str(self.exposureModeBox.currentText())
         meter_mode = str(self.meterModeBox.currentText())
         settings = {'exposure_mode': exposure_mode, 'meter_mode': meter_mode}
-        self.sock.sendObject((SET_CAMERA_SETTINGS, settings))
+        self.commands.setSettings(settings)
 
     def lensAnalyse(self):
-        self.sock.sendObject((TAKE_BGR, HEADER_ANALYZE, 1))
+        self.commands.send((TAKE_BGR, HEADER_ANALYZE, 1))
 
     def maxFps(self):
-        self.sock.sendObject((MAX_FPS,))
+        self.commands.send((MAX_FPS,))
 #        framerate = self.getCameraSetting('framerate')
-        self.framerateBox.setValue(self.getCameraSetting('framerate'))
+        self.getCameraSetting('framerate', self.framerateBox.setValue)
 
 #     def maxSpeed(self):
 #         self.sock.sendObject((MAX_SPEED,))
@@ -754,31 +836,56 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
         # if self.imageDialog == None :
         if self.imageDialog is None:
             self.imageDialog = ImageDialog(self)
+            self.imageDialog.stateSignal.connect(self.updatePreviewEnabled)
         self.imageDialog.show()
         self.imageDialog.displayImage(image)
 
-    def displayPlot(self, image):
+# Take the newest frame from the image thread, at most maxPreviewFps times per second
+    def displayPreview(self):
+        wait = self.lastPreviewTime + 1. / max(self.maxPreviewFps, 0.1) - time.time()
+        if wait > 0:
+            QTimer.singleShot(int(wait * 1000) + 1, self.displayPreview)
+            return
+        result = self.imageThread.takePreview()
+        if result is None or not self.imageThread.previewEnabled:
+            return
+        self.lastPreviewTime = time.time()
+        image, histos, sharpness = result
+        if histos is not None:
+            self.showHistogram(histos)
+        self.displayImage(image)
+
+# The image thread skips the display work while the preview window is minimized or closed
+    def updatePreviewEnabled(self):
+        enabled = self.imageDialog is None or not (self.imageDialog.isMinimized() or self.imageDialog.closedByUser)
+        if self.imageThread is not None:
+            self.imageThread.previewEnabled = enabled
+
+# A closed preview window is opened again on the next capture
+    def reopenPreview(self):
+        if self.imageDialog is not None:
+            self.imageDialog.closedByUser = False
+        self.updatePreviewEnabled()
+
+    def displayPlot(self, profiles):
         # if self.plotDialog == None:
         if self.plotDialog is None:
             self.plotDialog = PlotDialog(self)
         self.plotDialog.show()
-        self.plotDialog.displayImage(image)
+        self.plotDialog.displayProfiles(profiles)
+
+    def displayFocusMap(self, image):
+        if self.plotDialog is None:
+            self.plotDialog = PlotDialog(self)
+        self.plotDialog.show()
+        self.plotDialog.displayFocusMap(image)
 
     def showHistogram(self, histos):
-        figure = plt.figure()
-        axe = figure.add_subplot(111)
-        colors = ('b', 'g', 'r')
-        for i, col in enumerate(colors):
-            axe.plot(histos[i], color=col)
-        axe.set_xlim([0, 256])
-        axe.get_yaxis().set_visible(False)
-        figure.tight_layout()
-        figure.canvas.draw()
-        canvasWidth, canvasHeight = figure.canvas.get_width_height()
-        # buf = np.fromstring(figure.canvas.tostring_rgb(), dtype=np.uint8).reshape(canvasHeight, canvasWidth, 3)
-        buf = np.frombuffer(figure.canvas.tostring_rgb(), dtype=np.uint8).reshape(canvasHeight, canvasWidth, 3)
-        plt.close()
-        self.displayPlot(buf)
+        if self.histogramDialog is None:
+            self.histogramDialog = HistogramDialog(self, self.histogramLogScale)
+        self.histogramDialog.show()
+        self.histogramDialog.displayHistograms(histos)
+        self.histogramLogScale = self.histogramDialog.logScale()
 
 
     # ---------------------------------------------------------------------------------
@@ -823,15 +930,38 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
             self.connected = True
         # wait a bit to prevent runtime error if other side is not ready
         if self.connected:
+            socke.settimeout(None)  # Replies are waited for by the command client, with its own timeout
             self.sock = MessageSocket(socke)
+            self.sock.setNoDelay()  # Commands are small, send them at once
+            self.commands = CommandClient(self.sock, self.commandTimeout, self.settingsInterval)
+            self.commands.start()
             self.connectStatus.setText('image thread...')
             self.label.repaint()
             self.imageThread = ImageThread(self.ip_pi)
+            self.imageThread.workers = self.processingWorkers
+            self.imageThread.queueSize = self.processingQueueSize
+            self.imageThread.mergeProcesses = self.mergeProcesses
+            self.imageThread.mergeMemoryBudget = self.mergeMemoryBudget
+            self.imageThread.alignBrackets = self.alignBrackets
+            self.imageThread.previewMerge = self.previewMerge
+            self.imageThread.previewMergeReduce = self.previewMergeReduce
+            self.imageThread.backgroundMerges = self.backgroundMerges
+            self.imageThread.writerQueueSize = self.writerQueueSize
+            self.imageThread.fsyncPolicy = self.fsyncPolicy
+            self.imageThread.passthrough = self.passthrough
+            self.imageThread.passthroughEvery = self.passthroughEvery
+            self.imageThread.passthroughInterval = self.passthroughInterval
+            self.imageThread.histogramSamples = self.histogramSamples
+            self.imageThread.focusTiles = self.focusTiles
+            self.imageThread.sharpnessRoi = self.sharpnessRoi
+            self.imageThread.sharpnessReduce = self.sharpnessReduce
+            self.imageThread.focusPeaking = self.focusPeaking
+            self.updatePreviewEnabled()
             self.imageThread.headerSignal.connect(self.displayHeader)
-            self.imageThread.imageSignal.connect(self.displayImage)
+            self.imageThread.previewSignal.connect(self.displayPreview)
             self.imageThread.plotSignal.connect(self.displayPlot)
-            self.imageThread.histogramSignal.connect(self.showHistogram)
-            self.imageThread.statusSignal.connect(self.showImageThreadStatus)
+            self.imageThread.focusSignal.connect(self.displayFocusMap)
+            self.statusTimer.start(self.statusInterval)
             self.imageThread.start()
             # wait for thread to run
             for x in range(5):
@@ -844,7 +974,7 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
             self.imageThread.saveToFile(self.doSaveToFile, self.directory, self.startframe)
             self.imageThread.sharpness = self.sharpnessCheckBox.isChecked()
             self.imageThread.histos = self.histosCheckBox.isChecked()
-            self.imageThread.reduceFactor = self.reduceFactorBox.value()
+            self.imageThread.setReduceFactor(self.reduceFactorBox.value())
             # xxxx
             # print("here")
             self.connected = True
@@ -853,18 +983,35 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
 
     def disconnect(self):
         if self.connected:
-            self.sock.sendObject((TERMINATE,))
+            self.commands.send((TERMINATE,))
+            self.commands.stop()  # Sends what is queued
+            self.statusTimer.stop()
             self.sock.shutdown()
             self.sock.close()
             self.connected = False
             self.updateGuiState()
 
     # ---------------------------------------------------------------------------------
-    # Show status of image thread
+    # Show status of image thread, every statusInterval ms
     def showImageThreadStatus(self):
-        time.sleep(0)  # yield other threads
-        self.captureStatusInfo.setText(self.imageThread.captureStatusInfo)
+        self.captureStatusInfo.setText(self.imageThread.statusText())
         self.captureStatusFrame.setText('frame {0}'.format(self.imageThread.currentframe))
+        if self.imageThread.writer is not None:
+            self.captureStatusWriter.setText(self.imageThread.writer.statusText())
+        self.captureStatusPreview.setText('preview dropped {0}'.format(self.imageThread.droppedPreviews))
+        self.captureStatusInfo.setToolTip(self.imageThread.stageText())  # Per stage times
+        if self.commands is not None:
+            self.connectStatus.setToolTip(self.commands.statusText())
+        history = self.imageThread.sharpnessHistory
+        if self.displaySharpness and history and history[-1][0] != self.lastSharpnessCount:
+            self.lastSharpnessCount = history[-1][0]  # Redrawn only when a frame was measured
+            self.showSharpness(list(history))
+
+    def showSharpness(self, history):
+        if self.sharpnessDialog is None:
+            self.sharpnessDialog = SharpnessDialog(self)
+        self.sharpnessDialog.show()
+        self.sharpnessDialog.displayHistory(history)
 
     # ---------------------------------------------------------------------------------
     # Manage local settings
@@ -938,53 +1085,270 @@ class TelecineDialog(QDialog, Ui_TelecineDialog):
 # ---------------------------------------------------------------------------------
 # IMAGE window class
 class ImageDialog(QDialog):
+    stateSignal = pyqtSignal()  # Minimized, restored or closed
 
     def __init__(self, parent):
         super(ImageDialog, self).__init__(parent)
         self.setWindowTitle("Pi Film Capture:")
         self.mQImage = None
+        self.frame = None  # Pixels of mQImage, the QImage does not own them
+        self.rgbFrame = None  # Qt < 5.14 (no Format_BGR888): rgb conversion buffer, reused
+        self.pixmap = None  # mQImage scaled to the window, rebuilt on a new frame or a resize
+        self.frameShape = None
+        self.closedByUser = False
+
+    def closeEvent(self, event):
+        self.closedByUser = True
+        super(ImageDialog, self).closeEvent(event)
+        self.stateSignal.emit()
+
+    def changeEvent(self, event):
+        super(ImageDialog, self).changeEvent(event)
+        if event.type() == QEvent.WindowStateChange:
+            self.stateSignal.emit()
         
+# The bgr frame is shown without a copy: the image thread hands over a new array per frame,
+# kept alive in self.frame as long as the QImage uses it
     def displayImage(self, image):
-        height, width, byteValue = image.shape
-        byteValue = byteValue*width
-        image = image[..., ::-1].copy()
-        self.mQImage = QImage(image, width, height, byteValue, QImage.Format_RGB888)
-        self.setFixedSize(width, height)
+        height, width = image.shape[:2]
+        image = np.ascontiguousarray(image)
+        if hasattr(QImage, 'Format_BGR888'):
+            self.frame = image
+            self.mQImage = QImage(self.frame, width, height, 3 * width, QImage.Format_BGR888)
+        else:
+            if self.rgbFrame is None or self.rgbFrame.shape != image.shape:
+                self.rgbFrame = np.empty_like(image)
+            np.copyto(self.rgbFrame, image[..., ::-1])
+            self.frame = self.rgbFrame
+            self.mQImage = QImage(self.frame, width, height, 3 * width, QImage.Format_RGB888)
+        if self.frame.shape != self.frameShape:
+            self.frameShape = self.frame.shape
+            self.resize(width, height)  # New resolution only, the window can be resized
+        self.pixmap = None
         self.update()
 
+    def resizeEvent(self, event):
+        super(ImageDialog, self).resizeEvent(event)
+        self.pixmap = None
+
     def paintEvent(self, QPaintEvent):
         painter = QPainter()
         painter.begin(self)
         # if self.mQImage != None:
         if self.mQImage is not None:
-            painter.drawImage(0, 0, self.mQImage)
+            if self.pixmap is None:
+                if self.mQImage.size() == self.size():
+                    self.pixmap = QPixmap.fromImage(self.mQImage)
+                else:
+                    self.pixmap = QPixmap.fromImage(self.mQImage.scaled(self.size(), Qt.KeepAspectRatio,
+                                                                        Qt.SmoothTransformation))
+            if self.pixmap.size() != self.size():
+                painter.fillRect(self.rect(), Qt.black)
+            painter.drawPixmap((self.width() - self.pixmap.width()) // 2,
+                               (self.height() - self.pixmap.height()) // 2, self.pixmap)
         painter.end()
 
 # ---------------------------------------------------------------------------------
 # PLOT window class
-class PlotDialog(QDialog):
+# Lens analysis: one panel per (title, profile) where profile is an (n, 3) bgr array, drawn with QPainter
+class ProfileWidget(QWidget):
+    colors = (QColor(0, 0, 255), QColor(0, 160, 0), QColor(255, 0, 0))
+    margin = 20
 
     def __init__(self, parent):
-        super(PlotDialog, self).__init__(parent)
-        self.setWindowTitle("Plot")
+        super(ProfileWidget, self).__init__(parent)
+        self.setMinimumSize(900, 260)
+        self.profiles = []
+
+    def displayProfiles(self, profiles):
+        self.profiles = profiles
+        self.update()
+
+    def paintEvent(self, QPaintEvent):
+        painter = QPainter()
+        painter.begin(self)
+        painter.fillRect(self.rect(), Qt.white)
+        if self.profiles:
+            panelWidth = self.width() // len(self.profiles)
+            height = self.height() - 2 * self.margin
+            for k, (title, profile) in enumerate(self.profiles):
+                left = k * panelWidth + self.margin
+                width = panelWidth - 2 * self.margin
+                painter.setPen(QPen(Qt.black, 1))
+                painter.drawText(left, self.margin - 5, title)
+                painter.drawRect(left, self.margin, width, height)
+                # No more than 2 points per pixel
+                step = max(1, len(profile) // (2 * max(width, 1)))
+                values = np.asarray(profile[::step], dtype=np.float32)
+                x = left + np.arange(len(values), dtype=np.float32) * width / max(len(values) - 1, 1)
+                y = self.margin + height * (1. - values / 255.)
+                for i, color in enumerate(self.colors):
+                    painter.setPen(QPen(color, 1))
+                    painter.drawPolyline(QPolygonF([QPointF(px, py) for px, py in zip(x, y[:, i])]))
+        painter.end()
+
+
+# Focus map: rgb heatmap overlay, scaled to the widget keeping its aspect ratio
+class FocusMapWidget(QWidget):
+
+    def __init__(self, parent):
+        super(FocusMapWidget, self).__init__(parent)
+        self.mImage = None
         self.mQImage = None
-        
+
     def displayImage(self, image):
         height, width, byteValue = image.shape
         byteValue = byteValue*width
+        self.mImage = image  # QImage does not copy the buffer
         self.mQImage = QImage(image, width, height, byteValue, QImage.Format_RGB888)
-        self.setFixedSize(width, height)
+        self.setMinimumSize(width // 2, height // 2)
         self.update()
 
     def paintEvent(self, QPaintEvent):
         painter = QPainter()
         painter.begin(self)
-        # if self.mQImage != None:
         if self.mQImage is not None:
-            painter.drawImage(0, 0, self.mQImage)
+            scaled = self.mQImage.size().scaled(self.size(), Qt.KeepAspectRatio)
+            painter.drawImage(QRect(0, 0, scaled.width(), scaled.height()), self.mQImage)
+        painter.end()
+
+
+class PlotDialog(QDialog):
+
+    def __init__(self, parent):
+        super(PlotDialog, self).__init__(parent)
+        self.setWindowTitle("Plot")
+        self.profileWidget = ProfileWidget(self)
+        self.focusMapWidget = FocusMapWidget(self)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.profileWidget)
+        layout.addWidget(self.focusMapWidget, 1)
+
+    def displayProfiles(self, profiles):
+        self.profileWidget.displayProfiles(profiles)
+
+    def displayFocusMap(self, image):
+        self.focusMapWidget.displayImage(image)
+
+# ---------------------------------------------------------------------------------
+# SHARPNESS window class
+# Sparkline of the live sharpness (Laplacian variance of the centre of the frame)
+class SharpnessWidget(QWidget):
+    margin = 4
+
+    def __init__(self, parent):
+        super(SharpnessWidget, self).__init__(parent)
+        self.setMinimumSize(320, 80)
+        self.values = None
+
+    def displayValues(self, values):
+        self.values = np.asarray(values, dtype=np.float32)
+        self.update()
+
+    def paintEvent(self, QPaintEvent):
+        painter = QPainter()
+        painter.begin(self)
+        painter.fillRect(self.rect(), Qt.white)
+        if self.values is not None and len(self.values) > 1:
+            width = self.width() - 2 * self.margin
+            height = self.height() - 2 * self.margin
+            low = float(np.min(self.values))
+            span = max(float(np.max(self.values)) - low, 1e-6)
+            x = self.margin + np.arange(len(self.values), dtype=np.float32) * width / (len(self.values) - 1)
+            y = self.margin + height * (1. - (self.values - low) / span)
+            painter.setPen(QPen(QColor(0, 0, 0), 1))
+            painter.drawPolyline(QPolygonF([QPointF(px, py) for px, py in zip(x, y)]))
+            painter.setPen(QPen(QColor(255, 0, 0), 1))
+            peak = int(np.argmax(self.values))
+            painter.drawEllipse(QPointF(x[peak], y[peak]), 3, 3)
         painter.end()
 
 
+class SharpnessDialog(QDialog):
+
+    def __init__(self, parent):
+        super(SharpnessDialog, self).__init__(parent)
+        self.setWindowTitle("Sharpness")
+        self.sharpnessWidget = SharpnessWidget(self)
+        self.valueLabel = QLabel(self)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.sharpnessWidget)
+        layout.addWidget(self.valueLabel)
+
+    def displayHistory(self, history):
+        values = [sharpness for count, sharpness in history]
+        self.sharpnessWidget.displayValues(values)
+        self.valueLabel.setText('frame {0}: {1:.1f}  (max {2:.1f})'.format(history[-1][0], values[-1], max(values)))
+
+
+# ---------------------------------------------------------------------------------
+# HISTOGRAM window class
+# Draws the 256 bins histograms (b, g, r and luma) sent by the image thread with QPainter
+class HistogramWidget(QWidget):
+    colors = (QColor(0, 0, 255), QColor(0, 160, 0), QColor(255, 0, 0), QColor(128, 128, 128))
+    clipThreshold = 0.005  # Fraction of the pixels in the first/last bin shown as clipped
+
+    def __init__(self, parent):
+        super(HistogramWidget, self).__init__(parent)
+        self.setMinimumSize(320, 160)
+        self.histos = None
+        self.logScale = False
+
+    def displayHistograms(self, histos):
+        self.histos = [np.asarray(histo, dtype=np.float32).ravel() for histo in histos]
+        self.update()
+
+    def paintEvent(self, QPaintEvent):
+        painter = QPainter()
+        painter.begin(self)
+        painter.fillRect(self.rect(), Qt.white)
+        if self.histos is not None:
+            width = self.width()
+            height = self.height()
+            values = [np.log1p(histo) if self.logScale else histo for histo in self.histos]
+            top = max(float(np.max(value)) for value in values)
+            if top <= 0:
+                top = 1.
+            x = np.arange(256, dtype=np.float32) * (width - 1) / 255.
+            for histo, value, color in zip(self.histos, values, self.colors):
+                y = (height - 1) * (1. - value / top)
+                painter.setPen(QPen(color, 1))
+                painter.drawPolyline(QPolygonF([QPointF(px, py) for px, py in zip(x, y)]))
+                # Clipping indicators: shadows on the left, highlights on the right
+                total = float(np.sum(histo))
+                if total > 0:
+                    if histo[0] / total > self.clipThreshold:
+                        painter.fillRect(0, 0, 4, height, color)
+                    if histo[255] / total > self.clipThreshold:
+                        painter.fillRect(width - 4, 0, 4, height, color)
+        painter.end()
+
+
+class HistogramDialog(QDialog):
+
+    def __init__(self, parent, logScale=False):
+        super(HistogramDialog, self).__init__(parent)
+        self.setWindowTitle("Histogram")
+        self.histogramWidget = HistogramWidget(self)
+        self.logScaleCheckBox = QCheckBox("Log scale", self)
+        self.logScaleCheckBox.setChecked(logScale)
+        self.logScaleCheckBox.stateChanged['int'].connect(self.setLogScale)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.histogramWidget)
+        layout.addWidget(self.logScaleCheckBox)
+        self.setLogScale()
+
+    def setLogScale(self):
+        self.histogramWidget.logScale = self.logScaleCheckBox.isChecked()
+        self.histogramWidget.update()
+
+    def logScale(self):
+        return self.logScaleCheckBox.isChecked()
+
+    def displayHistograms(self, histos):
+        self.histogramWidget.displayHistograms(histos)
+
+
 
 commandDialog = None
 
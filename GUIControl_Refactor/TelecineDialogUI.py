@@ -23,7 +23,7 @@ class Ui_TelecineDialog(object):
         self.scrollArea.setWidgetResizable(False)
         self.scrollArea.setObjectName("scrollArea")
         self.scrollAreaWidgetContents = QtWidgets.QWidget()
-        self.scrollAreaWidgetContents.setGeometry(QtCore.QRect(0, 0, 694, 1057))
+        self.scrollAreaWidgetContents.setGeometry(QtCore.QRect(0, 0, 694, 1097))
         self.scrollAreaWidgetContents.setObjectName("scrollAreaWidgetContents")
         self.initGroupBox = QtWidgets.QGroupBox(self.scrollAreaWidgetContents)
         self.initGroupBox.setGeometry(QtCore.QRect(10, 10, 661, 141))
@@ -348,7 +348,7 @@ class Ui_TelecineDialog(object):
         self.pauseEdit.setGeometry(QtCore.QRect(40, 40, 31, 21))
         self.pauseEdit.setObjectName("pauseEdit")
         self.frameProcessingGroupBox = QtWidgets.QGroupBox(self.scrollAreaWidgetContents)
-        self.frameProcessingGroupBox.setGeometry(QtCore.QRect(10, 860, 661, 131))
+        self.frameProcessingGroupBox.setGeometry(QtCore.QRect(10, 900, 661, 131))
         self.frameProcessingGroupBox.setStyleSheet("QGroupBox#frameProcessingGroupBox { \n"
 "     border: 1px solid black; \n"
 " } ")
@@ -665,10 +665,10 @@ class Ui_TelecineDialog(object):
         self.label_2.setGeometry(QtCore.QRect(230, 20, 60, 20))
         self.label_2.setObjectName("label_2")
         self.messageTextEdit = QtWidgets.QTextEdit(self.scrollAreaWidgetContents)
-        self.messageTextEdit.setGeometry(QtCore.QRect(10, 1000, 661, 51))
+        self.messageTextEdit.setGeometry(QtCore.QRect(10, 1040, 661, 51))
         self.messageTextEdit.setObjectName("messageTextEdit")
         self.captureControlGroupBox = QtWidgets.QGroupBox(self.scrollAreaWidgetContents)
-        self.captureControlGroupBox.setGeometry(QtCore.QRect(10, 720, 661, 131))
+        self.captureControlGroupBox.setGeometry(QtCore.QRect(10, 720, 661, 171))
         self.captureControlGroupBox.setStyleSheet("QGroupBox#captureControlGroupBox { \n"
 "     border: 0.5px solid black; \n"
 " } ")
@@ -693,18 +693,28 @@ class Ui_TelecineDialog(object):
         self.reduceFactorBox.setProperty("value", 1)
         self.reduceFactorBox.setObjectName("reduceFactorBox")
         self.groupBox_17 = QtWidgets.QGroupBox(self.captureControlGroupBox)
-        self.groupBox_17.setGeometry(QtCore.QRect(370, 10, 281, 111))
+        self.groupBox_17.setGeometry(QtCore.QRect(370, 10, 281, 151))
         self.groupBox_17.setObjectName("groupBox_17")
         self.captureStatusInfo = QtWidgets.QLabel(self.groupBox_17)
-        self.captureStatusInfo.setGeometry(QtCore.QRect(10, 20, 91, 21))
+        self.captureStatusInfo.setGeometry(QtCore.QRect(10, 120, 261, 21))
         self.captureStatusInfo.setFrameShape(QtWidgets.QFrame.NoFrame)
         self.captureStatusInfo.setText("")
         self.captureStatusInfo.setObjectName("captureStatusInfo")
         self.captureStatusFrame = QtWidgets.QLabel(self.groupBox_17)
-        self.captureStatusFrame.setGeometry(QtCore.QRect(10, 40, 91, 21))
+        self.captureStatusFrame.setGeometry(QtCore.QRect(10, 20, 111, 21))
         self.captureStatusFrame.setFrameShape(QtWidgets.QFrame.NoFrame)
         self.captureStatusFrame.setText("")
         self.captureStatusFrame.setObjectName("captureStatusFrame")
+        self.captureStatusWriter = QtWidgets.QLabel(self.groupBox_17)
+        self.captureStatusWriter.setGeometry(QtCore.QRect(10, 100, 261, 21))
+        self.captureStatusWriter.setFrameShape(QtWidgets.QFrame.NoFrame)
+        self.captureStatusWriter.setText("")
+        self.captureStatusWriter.setObjectName("captureStatusWriter")
+        self.captureStatusPreview = QtWidgets.QLabel(self.groupBox_17)
+        self.captureStatusPreview.setGeometry(QtCore.QRect(10, 40, 111, 21))
+        self.captureStatusPreview.setFrameShape(QtWidgets.QFrame.NoFrame)
+        self.captureStatusPreview.setText("")
+        self.captureStatusPreview.setObjectName("captureStatusPreview")
         self.digitalGainLabel = QtWidgets.QLabel(self.groupBox_17)
         self.digitalGainLabel.setGeometry(QtCore.QRect(220, 20, 51, 20))
         self.digitalGainLabel.setFrameShape(QtWidgets.QFrame.Box)
@@ -0,0 +1,38 @@
+import os
+import sys
+import socket
+import pytest
+
+# The modules import each other by name, as when run from their directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ('Common', 'GUIControl_Refactor'):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+from MessageSocket import MessageSocket
+from StandInServer import StandInServer
+
+
+# Connect like the GUI: command socket, then image socket (binary headers offered unless legacy)
+def connectStandIn(server, offer=True):
+    server.start()
+    command = socket.create_connection(('localhost', server.port))
+    image = socket.create_connection(('localhost', server.port))
+    commandSock = MessageSocket(command)
+    commandSock.setNoDelay()
+    imageSock = MessageSocket(image)
+    if offer:
+        imageSock.offerHeaderProtocol()
+    return commandSock, imageSock
+
+
+@pytest.fixture
+def standIn():
+    servers = []
+
+    def start(offer=True, **options):
+        server = StandInServer(port=0, **options)
+        servers.append(server)
+        return (server,) + connectStandIn(server, offer)
+    yield start
+    for server in servers:
+        server.stop()
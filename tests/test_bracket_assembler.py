@@ -0,0 +1,85 @@
+import time
+import threading
+import numpy as np
+
+from BracketAssembler import BracketAssembler
+
+SHAPE = (4, 6, 3)
+
+
+def exposure(value):
+    return np.full(SHAPE, value, np.uint8)
+
+
+# Write the exposures of a frame, returns the set when complete
+def writeFrame(assembler, count, brackets=3):
+    for bracket in range(brackets, 0, -1):
+        bracketSet, index = assembler.reserve(count, bracket, brackets, SHAPE)
+        complete = assembler.write(bracketSet, index, exposure(count * 10 + bracket), bracket * 1000)
+    return bracketSet if complete else None
+
+
+def test_out_of_order_exposures_assembled():
+    assembler = BracketAssembler(maxSets=2)
+    slots = [assembler.reserve(7, bracket, 3, SHAPE) for bracket in (1, 3, 2)]
+    assert [index for _, index in slots] == [2, 0, 1]
+    assert assembler.reserve(7, 2, 3, SHAPE) is None  # Same exposure twice
+    results = [assembler.write(bracketSet, index, exposure(index), index) for bracketSet, index in slots]
+    assert results == [False, False, True]
+    bracketSet = slots[0][0]
+    assert [int(image[0, 0, 0]) for image in bracketSet.images()] == [0, 1, 2]
+    assert assembler.pendingSets() == 0
+
+
+def test_buffers_reused():
+    assembler = BracketAssembler(maxSets=2)
+    for count in range(10):
+        bracketSet = writeFrame(assembler, count)
+        assembler.release(bracketSet)
+    assert assembler.allocated == 1
+
+
+def test_full_pool_waits_for_a_released_set():
+    assembler = BracketAssembler(maxSets=2, timeout=10.)
+    held = [writeFrame(assembler, count) for count in (1, 2)]
+    done = []
+    worker = threading.Thread(target=lambda: done.append(writeFrame(assembler, 3)))
+    worker.start()
+    time.sleep(0.2)
+    assert not done  # Back pressure, nothing evicted
+    assembler.release(held[0])
+    worker.join(2.)
+    assert done[0] is not None and done[0].count == 3
+    assert assembler.evictedSets == 0
+
+
+def test_set_being_written_not_evicted():
+    evicted = []
+    assembler = BracketAssembler(maxSets=1, timeout=0.1, evicted=evicted.append)
+    bracketSet, index = assembler.reserve(1, 3, 3, SHAPE)
+    time.sleep(0.2)
+    assembler.evictExpired()
+    assert evicted == [] and assembler.pendingSets() == 1  # A worker still writes it
+    assembler.write(bracketSet, index, exposure(1), 3000)
+
+
+def test_incomplete_sets_evicted_and_reported():
+    evicted = []
+    assembler = BracketAssembler(maxSets=2, timeout=0.5, evicted=evicted.append)
+    for count in (1, 2):
+        bracketSet, index = assembler.reserve(count, 3, 3, SHAPE)  # Exposures 2 and 1 lost
+        assembler.write(bracketSet, index, exposure(count), 3000)
+    start = time.time()
+    bracketSet = writeFrame(assembler, 3)  # Waits until the incomplete sets expire
+    assert time.time() - start > 0.3
+    assert bracketSet is not None and bracketSet.count == 3
+    assert sorted(evicted) == [1, 2] and assembler.evictedSets == 2
+
+
+def test_clear_not_reported():
+    evicted = []
+    assembler = BracketAssembler(maxSets=2, evicted=evicted.append)
+    bracketSet, index = assembler.reserve(1, 3, 3, SHAPE)
+    assembler.write(bracketSet, index, exposure(1), 3000)
+    assembler.clear()
+    assert assembler.pendingSets() == 0 and evicted == [] and assembler.evictedSets == 0
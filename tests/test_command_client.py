@@ -0,0 +1,103 @@
+import time
+import pytest
+from concurrent.futures import TimeoutError
+from Constants import *
+from CommandClient import CommandClient, CommandTimeout
+
+
+@pytest.fixture
+def client(standIn):
+    clients = []
+
+    def start(timeout=2., settingsInterval=0.1, **options):
+        server, commandSock, imageSock = standIn(**options)
+        commands = CommandClient(commandSock, timeout, settingsInterval)
+        commands.start()
+        clients.append((commands, commandSock))
+        return server, commands
+    yield start
+    for commands, commandSock in clients:
+        commands.stop()
+        commandSock.close()
+
+
+def test_pipelined_getters(client):
+    server, commands = client(latency=0.1)
+    commands.request((GET_CAMERA_SETTING, 'iso')).result(2)  # Warm up
+    start = time.time()
+    futures = [commands.request((GET_CAMERA_SETTINGS,)),
+               commands.request((GET_CAMERA_SETTING, 'exposure_speed')),
+               commands.request((GET_MOTOR_SETTINGS,)),
+               commands.request((GET_CAMERA_SETTING, 'resolution'))]
+    replies = [future.result(2) for future in futures]
+    elapsed = time.time() - start
+    assert replies[0]['shutter_speed'] == 8000
+    assert replies[1] == 8000
+    assert replies[2]['steps_per_rev'] == 200
+    assert replies[3] == (server.width, server.height)
+    assert elapsed < 0.3  # One round trip, not four
+    ids = [future.requestId for future in futures]
+    assert ids == sorted(set(ids))
+
+
+def test_command_without_reply_is_not_a_request(client):
+    server, commands = client()
+    with pytest.raises(ValueError):
+        commands.request((MAX_FPS,))
+    commands.send((MAX_FPS,))
+    assert commands.request((GET_CAMERA_SETTING, 'framerate')).result(2) == 30.
+
+
+def test_settings_batched_last_write_wins(client):
+    server, commands = client(settingsInterval=10.)
+    for shutter in range(6000, 6030):
+        commands.setSettings({'shutter_speed': shutter})
+    commands.setSettings({'iso': 200})
+    before = server.commands
+    # A request sends the pending settings first, in order
+    assert commands.request((GET_CAMERA_SETTING, 'shutter_speed')).result(2) == 6029
+    assert server.commands - before == 2
+    assert server.cameraSettings['iso'] == 200
+    assert commands.settingsSent == 1 and commands.settingsSaved == 30
+
+
+def test_settings_flushed_after_interval(client):
+    server, commands = client(settingsInterval=0.05)
+    commands.setSettings({'iso': 400})
+    deadline = time.time() + 2.
+    while server.cameraSettings['iso'] != 400 and time.time() < deadline:
+        time.sleep(0.01)
+    assert server.cameraSettings['iso'] == 400
+
+
+def test_lost_reply_resyncs(client):
+    server, commands = client(timeout=0.3)
+    server.dropReplies = 1  # The Pi does not answer the next request
+    lost = commands.request((GET_CAMERA_SETTING, 'iso'))
+    with pytest.raises(CommandTimeout):
+        lost.result(2)
+    # Requests sent after the timeout are matched to their own replies again
+    assert commands.request((GET_CAMERA_SETTING, 'resolution')).result(2) == (server.width, server.height)
+    assert commands.request((GET_CAMERA_SETTING, 'iso')).result(2) == 100
+    assert commands.request((GET_MOTOR_SETTINGS,)).result(2)['speed'] == 100
+    assert commands.inStep() and commands.resyncs == 1
+
+
+def test_late_reply_dropped(client):
+    server, commands = client(timeout=0.4, latency=0.6)
+    slow = commands.request((GET_CAMERA_SETTING, 'iso'))
+    time.sleep(0.1)
+    server.latency = 0.02  # Only that reply is late, the ones after it wait behind it
+    with pytest.raises(CommandTimeout):
+        slow.result(2)
+    # The late reply and the sentinel reply are dropped, then the channel is in step
+    assert commands.request((GET_CAMERA_SETTING, 'resolution')).result(2) == (server.width, server.height)
+    assert commands.droppedReplies == 2 and commands.resyncs == 1
+
+
+def test_closed_connection_fails_pending(client):
+    server, commands = client(latency=0.5)
+    future = commands.request((GET_CAMERA_SETTING, 'iso'))
+    server.stop()
+    with pytest.raises(ConnectionError):
+        future.result(2)
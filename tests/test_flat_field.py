@@ -0,0 +1,97 @@
+import os
+import numpy as np
+import pytest
+
+from ImageProcessing import FlatFieldAccumulator, saveCalibrationTable, loadCalibrationTable
+
+SHAPE = (120, 160, 3)
+DUST = (slice(40, 60), slice(50, 80))
+
+
+# A vignetted flat frame with sensor noise
+def flatFrame(rng, level=190.):
+    rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    r2 = ((rows - SHAPE[0] / 2) / SHAPE[0]) ** 2 + ((cols - SHAPE[1] / 2) / SHAPE[1]) ** 2
+    flat = level * (1. - 0.3 * r2)
+    image = flat[..., None] + rng.normal(0., 2., SHAPE)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def test_dust_in_first_frame_left_out():
+    rng = np.random.default_rng(1)
+    accumulator = FlatFieldAccumulator(SHAPE)
+    frames = [flatFrame(rng) for _ in range(8)]
+    frames[0][DUST] = 40  # Speck in a warmup frame
+    for image in frames:
+        assert accumulator.add(image)
+    assert accumulator.frames == 8 and accumulator.rejected == 0
+    assert abs(float(np.mean(accumulator.mean[DUST])) - 190.) < 3.
+    assert np.all(accumulator.count[DUST] <= 7)  # Frame 0 left out (a few noisy pixels too)
+
+
+def test_dust_after_warmup_left_out():
+    rng = np.random.default_rng(2)
+    accumulator = FlatFieldAccumulator(SHAPE)
+    for i in range(8):
+        image = flatFrame(rng)
+        if i == 5:
+            image[DUST] = 40
+        accumulator.add(image)
+    assert abs(float(np.mean(accumulator.mean[DUST])) - 190.) < 3.
+
+
+def test_flicker_frame_rejected():
+    rng = np.random.default_rng(3)
+    for flicker in (1, 5):  # In the warmup frames and after
+        accumulator = FlatFieldAccumulator(SHAPE)
+        results = [accumulator.add(flatFrame(rng, 140. if i == flicker else 190.)) for i in range(6)]
+        accumulator.gains()
+        assert accumulator.rejected == 1 and accumulator.frames == 5
+        assert abs(accumulator.level - 190. * 0.95) < 5.
+        if flicker == 5:
+            assert results[flicker] is False
+
+
+def test_fewer_frames_than_warmup():
+    rng = np.random.default_rng(4)
+    accumulator = FlatFieldAccumulator(SHAPE)
+    accumulator.add(flatFrame(rng))
+    accumulator.add(flatFrame(rng))
+    gains = accumulator.gains()
+    assert accumulator.frames == 2
+    assert gains.shape == SHAPE and gains.dtype == np.float32
+    # Corners darker than the centre: larger gains
+    assert gains[0, 0, 1] > 1. > gains[SHAPE[0] // 2, SHAPE[1] // 2, 1]
+
+
+def test_all_frames_rejected():
+    rng = np.random.default_rng(5)
+    accumulator = FlatFieldAccumulator(SHAPE)
+    accumulator.add(flatFrame(rng, 60.))  # Levels too far apart: none is the reference
+    accumulator.add(flatFrame(rng, 200.))
+    with pytest.raises(ValueError):
+        accumulator.gains()
+    assert accumulator.frames == 0 and accumulator.rejected == 2
+    with pytest.raises(ValueError):
+        FlatFieldAccumulator(SHAPE).gains()  # No frame at all
+
+
+def test_fewer_frames_than_minimum():
+    rng = np.random.default_rng(6)
+    accumulator = FlatFieldAccumulator(SHAPE, minFrames=3)
+    accumulator.add(flatFrame(rng))
+    accumulator.add(flatFrame(rng))
+    with pytest.raises(ValueError):
+        accumulator.gains()
+
+
+def test_calibration_table_saved_over(tmp_path):
+    path = str(tmp_path / 'calibrate.npy')
+    first = np.full((4, 6, 3), 1.5, np.float32)
+    saveCalibrationTable(path, first)
+    loaded = loadCalibrationTable(path)
+    assert loaded.dtype == np.float16 and np.all(loaded == 1.5)
+    saveCalibrationTable(path, first * 0.5)  # While the previous table is still in use
+    assert np.all(loadCalibrationTable(path) == 0.75)
+    assert np.all(loaded == 1.5)
+    assert os.listdir(str(tmp_path)) == ['calibrate.npy']
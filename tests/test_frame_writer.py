@@ -0,0 +1,39 @@
+import os
+import time
+import numpy as np
+
+from Constants import FSYNC_CLIP
+from FrameWriter import FrameWriter
+
+
+def test_files_written_in_order_and_released(tmp_path):
+    writer = FrameWriter(queueSize=4, fsync=FSYNC_CLIP)
+    writer.start()
+    released = []
+    for i in range(10):
+        writer.writeBytes(str(tmp_path / 'clip' / ('image_%05d.jpg' % i)), bytes([i]) * 100,
+                          lambda i=i: released.append(i))
+    writer.writeImage(str(tmp_path / 'clip' / 'merged.jpg'), np.zeros((16, 16, 3), np.uint8))
+    writer.stop()
+    assert released == list(range(10))
+    assert writer.filesWritten == 11 and writer.errors == 0 and writer.unsynced == []
+    with open(str(tmp_path / 'clip' / 'image_00003.jpg'), 'rb') as file:
+        assert file.read() == bytes([3]) * 100
+    assert os.path.getsize(str(tmp_path / 'clip' / 'merged.jpg')) > 0
+
+
+def test_status_shows_errors_and_idle_rate(tmp_path):
+    writer = FrameWriter()
+    writer.start()
+    (tmp_path / 'file').write_bytes(b'')
+    writer.writeBytes(str(tmp_path / 'file' / 'image_00001.jpg'), b'x')  # file is not a directory
+    writer.writeBytes(str(tmp_path / 'image_00002.jpg'), b'x' * 1000000)
+    while writer.rateBytes == 0:  # Both batches done
+        time.sleep(0.01)
+    writer.rateStart -= 1.  # As if a second went by during the batch
+    writer.updateRate()
+    assert writer.rate > 0.
+    assert writer.statusText().endswith('errors 1')
+    writer.rateStart -= 1.  # Idle for a second
+    assert writer.statusText().startswith('write 0.0 MB/s')
+    writer.stop()
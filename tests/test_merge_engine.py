@@ -0,0 +1,22 @@
+import numpy as np
+
+from Constants import MERGE_MERTENS
+from MergeEngine import MergeEngine
+
+
+def test_merge_in_spawned_processes():
+    engine = MergeEngine(2)
+    engine.start()  # Before any merge, as the image thread does
+    try:
+        assert engine.executor._mp_context.get_start_method() == 'spawn'
+        images = [np.full((32, 48, 3), value, np.uint8) for value in (200, 120, 40)]
+        images[1][8:24, 12:36] = 180
+        merged = engine.merge(images, (8000, 4000, 2000), MERGE_MERTENS)
+        assert merged.shape == (32, 48, 3) and merged.dtype == np.float32
+        assert abs(float(merged.min())) < 1e-5 and abs(float(merged.max()) - 1.) < 1e-5  # Normalized
+        finish = engine.merge(images, (8000, 4000, 2000), MERGE_MERTENS,
+                              finish=lambda out: (out * 255).astype(np.uint8))
+        assert finish.dtype == np.uint8
+    finally:
+        engine.shutdown()
+    assert engine.executor is None and engine.slotCount == 0
@@ -0,0 +1,89 @@
+import socket
+import threading
+import numpy as np
+import pytest
+from fractions import Fraction
+from Constants import *
+from MessageSocket import MessageSocket, BufferPool, HEADER_VERSION, packHeader, unpackHeader
+
+
+def takeImage(commandSock, imageSock):
+    commandSock.sendObject((TAKE_IMAGE,))
+    header = imageSock.receiveHeader()
+    jpeg = imageSock.receiveMsg()
+    return header, jpeg
+
+
+def test_binary_headers_negotiated(standIn):
+    server, commandSock, imageSock = standIn(offer=True)
+    header, jpeg = takeImage(commandSock, imageSock)
+    assert server.imageSock.headerVersion == HEADER_VERSION
+    assert header['type'] == HEADER_IMAGE and header['count'] == 0 and header['bracket'] == 0
+    assert header['gains'] == (1.5, 1.25)  # Floats, exact values of the Fractions
+    assert bytes(jpeg[:2]) == b'\xff\xd8'
+    commandSock.close()
+
+
+def test_legacy_server_ignores_offer(standIn):
+    server, commandSock, imageSock = standIn(offer=True, legacy=True)
+    header, jpeg = takeImage(commandSock, imageSock)
+    assert server.imageSock.headerVersion == 0
+    assert header['gains'] == (Fraction(3, 2), Fraction(5, 4))  # str((obj,'')) header
+    commandSock.close()
+
+
+def test_legacy_client_without_offer(standIn):
+    server, commandSock, imageSock = standIn(offer=False)
+    header, jpeg = takeImage(commandSock, imageSock)  # After the server waited for the offer
+    assert server.imageSock.headerVersion == 0
+    assert header['type'] == HEADER_IMAGE and header['shutter'] == 8000
+    commandSock.close()
+
+
+def test_header_round_trip():
+    header = {'type': HEADER_IMAGE, 'count': 12, 'bracket': 3, 'shutter': 4000,
+              'gains': (Fraction(23, 20), Fraction(5, 4)), 'analog_gain': Fraction(23, 20),
+              'digital_gain': Fraction(1), 'extra': 'kept'}
+    decoded = unpackHeader(packHeader(header))
+    assert decoded['gains'] == (float(Fraction(23, 20)), 1.25)
+    assert decoded['analog_gain'] == float(Fraction(23, 20))
+    assert decoded['extra'] == 'kept' and decoded['count'] == 12 and decoded['bracket'] == 3
+    assert 'count' not in unpackHeader(packHeader({'type': HEADER_STOP}))
+
+
+def test_unknown_header_version_refused():
+    buf = bytearray(packHeader({'type': HEADER_IMAGE, 'count': 1}))
+    buf[1] = HEADER_VERSION + 1
+    with pytest.raises(ValueError):
+        unpackHeader(buf)
+
+
+def test_leased_receive_through_staging():
+    a, b = socket.socketpair()
+    sender, receiver = MessageSocket(a), MessageSocket(b)
+    rng = np.random.default_rng(1)
+    # Small messages come several per recv_into, large ones straight into their buffer
+    messages = [rng.integers(0, 256, size, dtype=np.uint8).tobytes()
+                for size in (0, 5, 100, 70000, 3, 300000, 65536, 12)] * 3
+    thread = threading.Thread(target=lambda: [sender.sendMsg(m) for m in messages])
+    thread.start()
+    pool = BufferPool()
+    for message in messages:
+        lease = receiver.receiveMsgLeased(pool)
+        assert bytes(lease.view) == message
+        lease.release()
+    thread.join()
+    assert pool.allocated <= 2  # Buffers are reused
+    a.close()
+    assert receiver.receiveMsgLeased(pool) is None
+    b.close()
+
+
+def test_lease_kept_by_another_user():
+    pool = BufferPool()
+    lease = pool.lease(1000)
+    kept = lease.acquire()
+    lease.release()
+    assert pool.lease(1000).buf is not lease.buf  # Still used
+    kept.release()
+    assert pool.lease(1000).buf is lease.buf